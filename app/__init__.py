@@ -1,67 +1,180 @@
 import logging
 from logging.handlers import RotatingFileHandler
 import os
+import sqlite3
 
-import sentry_sdk
-from sentry_sdk.integrations.flask import FlaskIntegration
-from sentry_sdk.integrations.sqlalchemy import SqlalchemyIntegration
-
-from flask import Flask, request, current_app
-from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
+from flask import Flask
 from flask_login import LoginManager
-from flask_mail import Mail
 from flask_bootstrap import Bootstrap
-from flask_moment import Moment
 from flask_uploads import UploadSet, IMAGES, configure_uploads
 
 from config import Config, basedir
+from app.util.routing import RoutingSQLAlchemy
+from app.util.lazy import LazyExtension, LazyBytecodeCache
+
+
+db = RoutingSQLAlchemy()
+
+
+def sqlite_pragmas(pragmas):
+    """
+    A connect listener setting pragmas ({name: value}) on SQLite connections
+    """
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        if not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute('PRAGMA {} = {}'.format(name, value))
+        cursor.close()
+    return set_sqlite_pragmas
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    """
+    Filter for alembic's autogenerate: the search index tables are created by
+    app/search.py, not the models, and mustn't be dropped, nor must SQLite's
+    own sqlite_sequence (kept for AUTOINCREMENT tables). Expression indexes
+    can't be reflected, so they'd be detected as new on every run; they're
+    written into migrations by hand.
+    """
+    from sqlalchemy import Column
+    from app.search import is_index_table
+    if type_ == 'table' and reflected and compare_to is None and \
+            (is_index_table(name) or name == 'sqlite_sequence'):
+        return False
+    if type_ == 'index' and not reflected and \
+            any(not isinstance(expression, Column) for expression in object.expressions):
+        return False
+    return True
+
+
+def load_migrate(app):
+    from flask_migrate import Migrate
+    Migrate(app, db, include_object=include_object)
+    return app.extensions['migrate']
 
 
-if Config.SENTRY_DSN:
-    sentry_sdk.init(
-        dsn=Config.SENTRY_DSN,
-        integrations=[FlaskIntegration(), SqlalchemyIntegration()]
-    )
+def load_mail():
+    from flask_mail import Mail
+    return Mail()
 
 
-app = Flask(__name__)
-app.config.from_object(Config)
+def load_moment():
+    # Flask-Moment pulls in distutils (and with it setuptools), which
+    # dominates its import time
+    from flask_moment import _moment
+    return _moment
 
-db = SQLAlchemy(app)
-migrate = Migrate(app, db)
-login = LoginManager(app)
+
+# Only `flask db` needs Flask-Migrate (and alembic), only sending email needs
+# Flask-Mail, and only rendering a page needs Flask-Moment, so each is
+# imported on first use; CLI commands and workers never load them
+mail = LazyExtension(load_mail)
+moment = LazyExtension(load_moment)
+
+
+def inject_moment():
+    return dict(moment=moment)
+
+
+login = LoginManager()
 login.login_view = 'auth.login'
-mail = Mail(app)
-bootstrap = Bootstrap(app)
-moment = Moment(app)
+# API clients get a 401 rather than a redirect to the login form
+login.blueprint_login_views = {'api': None}
+bootstrap = Bootstrap()
 
-images = UploadSet('images', IMAGES)
-configure_uploads(app, images)
+from app.util.perf import Instrumentation
+perf = Instrumentation()
 
-from app.errors import bp as errors_bp
-app.register_blueprint(errors_bp)
+from app.util.activity import ActivityTracker
+activity = ActivityTracker()
 
-from app.auth import bp as auth_bp
-app.register_blueprint(auth_bp, url_prefix='/auth')
+from app.util.avatars import AvatarStore
+avatars = AvatarStore()
 
-from app.main import bp as main_bp
-app.register_blueprint(main_bp)
+from app.util.credentials import PasswordHasher, RateLimiter
+passwords = PasswordHasher()
+login_limiter = RateLimiter()
+
+images = UploadSet('images', IMAGES)
 
-if not app.debug and not app.testing:
-    logs_path = os.path.join(basedir, 'logs')
-    if not os.path.exists(logs_path):
-        os.mkdir(logs_path)
-    file_handler = RotatingFileHandler(os.path.join(logs_path, 'openchat.log'),
-                                       maxBytes=10240, backupCount=10)
-    file_handler.setFormatter(logging.Formatter(
-        '%(asctime)s %(levelname)s: %(message)s '
-        '[in %(pathname)s:%(lineno)d]'))
-    app.logger.addHandler(file_handler)
 
-    app.logger.setLevel(logging.INFO)
-    app.logger.info('OpenChat startup')
+def create_app(config_class=Config):
+    """
+    Build an application from config_class. Extensions that only some
+    commands need are set up on first use, and nothing is written to disk
+    until it's needed.
+    """
+    if config_class.SENTRY_DSN:
+        # Imported only when configured; the SDK and its integrations are a
+        # large part of startup time
+        import sentry_sdk
+        from sentry_sdk.integrations.flask import FlaskIntegration
+        from sentry_sdk.integrations.sqlalchemy import SqlalchemyIntegration
+        sentry_sdk.init(
+            dsn=config_class.SENTRY_DSN,
+            integrations=[FlaskIntegration(), SqlalchemyIntegration()]
+        )
+
+    app = Flask(__name__)
+    app.config.from_object(config_class)
+
+    db.init_app(app)
+    # On this app's own engines only, so other SQLite connections in the
+    # process (scripts, offline migrations) are left alone
+    db.on_connect(app, sqlite_pragmas(app.config['SQLITE_PRAGMAS']))
+    app.extensions['migrate'] = LazyExtension(lambda: load_migrate(app))
+    app.extensions['moment'] = moment
+    app.context_processor(inject_moment)
+    login.init_app(app)
+    bootstrap.init_app(app)
+
+    # Compiled templates are kept on disk (`flask templates` fills the cache
+    # at deploy time), so new processes don't recompile them on first render
+    app.jinja_env.bytecode_cache = LazyBytecodeCache(app.config['TEMPLATE_CACHE_DIR'])
+
+    perf.init_app(app, db)
+    activity.init_app(app, db)
+    avatars.init_app(app)
+    passwords.init_app(app)
+    login_limiter.configure(app.config['LOGIN_ATTEMPTS'], app.config['LOGIN_ATTEMPT_PERIOD'])
+    configure_uploads(app, images)
+
+    from app.util import filters, fragments
+    filters.init_app(app)
+    fragments.init_app(app)
+
+    from app import search
+    search.init_app(app)
+
+    from app.errors import bp as errors_bp
+    app.register_blueprint(errors_bp)
+
+    from app.auth import bp as auth_bp
+    app.register_blueprint(auth_bp, url_prefix='/auth')
+
+    from app.main import bp as main_bp
+    app.register_blueprint(main_bp)
+
+    from app.api import bp as api_bp
+    app.register_blueprint(api_bp, url_prefix='/api/v1')
+
+    if not app.debug and not app.testing:
+        logs_path = os.path.join(basedir, 'logs')
+        if not os.path.exists(logs_path):
+            os.mkdir(logs_path)
+        file_handler = RotatingFileHandler(os.path.join(logs_path, 'openchat.log'),
+                                           maxBytes=10240, backupCount=10)
+        file_handler.setFormatter(logging.Formatter(
+            '%(asctime)s %(levelname)s: %(message)s '
+            '[in %(pathname)s:%(lineno)d]'))
+        app.logger.addHandler(file_handler)
+
+        app.logger.setLevel(logging.INFO)
+        app.logger.info('OpenChat startup')
+
+    return app
 
 
-from app.util import filters
 from app import models
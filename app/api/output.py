@@ -0,0 +1,51 @@
+"""
+JSON encoding and compression for API responses.
+"""
+from datetime import datetime
+import gzip
+import json
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; the stdlib encoder is used without it
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; without it responses are gzipped
+    brotli = None
+
+from flask import current_app, request
+
+
+def default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(value)
+
+
+def dumps(data):
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, default=default, separators=(',', ':')).encode('utf-8')
+
+
+def compress(response):
+    """
+    Brotli- or gzip-encode a response body if the client accepts it and it's
+    big enough to be worth it
+    """
+    response.vary.add('Accept-Encoding')
+    if response.direct_passthrough or response.status_code != 200 or \
+            'Content-Encoding' in response.headers or \
+            response.content_length < current_app.config['API_COMPRESS_MIN_SIZE']:
+        return response
+
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        response.set_data(brotli.compress(response.get_data(), quality=4))
+        response.headers['Content-Encoding'] = 'br'
+    elif accepted['gzip']:
+        response.set_data(gzip.compress(response.get_data(), compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
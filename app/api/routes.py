@@ -0,0 +1,205 @@
+"""
+Read-only JSON versions of the main pages under /api/v1.
+
+Lists are built from the same queries as the HTML views, but select only the
+requested columns (?fields=id,title,...) so rows come back as plain tuples
+and are serialized without loading ORM objects. Pages are addressed with the
+same after/before cursors, and the response carries next/prev links.
+"""
+from flask import abort, current_app, request, url_for
+from flask_login import current_user, login_required
+
+from app.api import bp
+from app.api.output import compress, dumps
+from app.models import User, Post, Image, Chat, Comment, PostRank, ChatRank, UserRank, \
+    fit_rendition
+from app.util.pagination import paginate, encode_cursor
+from app.util.filters import censor
+
+
+POST_FIELDS = {
+    'id': Post.id,
+    'title': Post.title,
+    'body': Post.body,
+    'created_at': Post.created_at,
+    'like_count': Post.like_count,
+    'author': User.username,
+    'chat': Chat.name,
+    # Converted to the URL of the largest rendition by serialize()
+    'image': Image.renditions,
+}
+
+COMMENT_FIELDS = {
+    'id': Comment.id,
+    'parent_id': Comment.parent_comment_id,
+    'body': Comment.body,
+    'created_at': Comment.created_at,
+    'author': User.username,
+}
+
+CHAT_FIELDS = {
+    'id': Chat.id,
+    'name': Chat.name,
+    'about': Chat.about,
+    'created_at': Chat.created_at,
+    'follower_count': Chat.follower_count,
+}
+
+USER_FIELDS = {
+    'id': User.id,
+    'username': User.username,
+    'about_me': User.about_me,
+    'score': User.score,
+    'last_seen': User.last_seen,
+}
+
+
+# Applied to selected columns' values before encoding
+CONVERT = {
+    # Censored as they are on the HTML pages
+    Post.title: censor,
+    Post.body: censor,
+    # Only processed renditions are served, never the original upload
+    Image.renditions: lambda renditions: fit_rendition(renditions, float('inf'), float('inf')),
+}
+
+
+def serialize(fields, names, row):
+    return {name: CONVERT[fields[name]](value) if fields[name] in CONVERT else value
+            for name, value in zip(names, row)}
+
+
+def with_posts(query):
+    return query.join(User, Post.author).join(Chat, Post.chat).outerjoin(Image, Post.attachment)
+
+
+def selected(fields):
+    """
+    The ?fields= subset of fields, in request order, or all of them
+    """
+    names = request.args.get('fields')
+    if not names:
+        return list(fields)
+    names = names.split(',')
+    if any(name not in fields for name in names):
+        abort(400)
+    return names
+
+
+def fetch(query, fields, names, per_page, *keys):
+    """
+    Run a keyset-paginated query for the named columns, returning
+    ([{name: value}], last row, next_url, prev_url). The sort keys are
+    selected too, under private labels, so the cursors can be built from the
+    rows.
+    """
+    labels = ['_key{}'.format(i) for i in range(len(keys))]
+    query = query.with_entities(*[fields[name].label(name) for name in names] +
+                                [key.label(label) for key, label in zip(keys, labels)])
+    per_page = min(max(request.args.get('limit', per_page, type=int), 1),
+                   current_app.config['API_MAX_PER_PAGE'])
+    rows, next_url, prev_url = paginate(query, per_page, *keys, attrs=labels)
+    items = [serialize(fields, names, row) for row in rows]
+    return items, rows[-1] if rows else None, next_url, prev_url
+
+
+def page(query, fields, per_page, *keys):
+    items, _, next_url, prev_url = fetch(query, fields, selected(fields), per_page, *keys)
+    return respond(dict(items=items, next=next_url, prev=prev_url))
+
+
+def respond(data):
+    response = current_app.response_class(dumps(data), mimetype='application/json')
+    return compress(response)
+
+
+@bp.errorhandler(400)
+@bp.errorhandler(401)
+@bp.errorhandler(404)
+def error(e):
+    response = respond(dict(error=e.name))
+    response.status_code = e.code
+    return response
+
+
+# Feeds
+
+@bp.route('/feed')
+@login_required
+def feed():
+    per_page = current_app.config['POSTS_PER_PAGE']
+    if request.args.get('source') == 'followed':
+        return page(with_posts(current_user.followed_posts()), POST_FIELDS, per_page,
+                    Post.created_at, Post.id)
+
+    posts, keys = current_user.timeline()
+    items, last, next_url, prev_url = fetch(with_posts(posts), POST_FIELDS, selected(POST_FIELDS),
+                                            per_page, *keys)
+    if next_url is None and last is not None and current_user.has_older_posts(*last[-2:]):
+        # Past the end of the stored timeline: read followed chats directly
+        next_url = url_for('api.feed', source='followed', fields=request.args.get('fields'),
+                           limit=request.args.get('limit'), after=encode_cursor(last[-2:]))
+    return respond(dict(items=items, next=next_url, prev=prev_url))
+
+
+@bp.route('/chats/<name>/posts')
+@login_required
+def chat_posts(name):
+    chat = Chat.query.filter_by(name=name).first_or_404()
+    return page(with_posts(Post.query.filter(Post.chat_id == chat.id)), POST_FIELDS,
+                current_app.config['POSTS_PER_PAGE'], Post.created_at, Post.id)
+
+
+@bp.route('/users/<username>/posts')
+@login_required
+def user_posts(username):
+    user = User.query.filter_by(username=username).first_or_404()
+    return page(with_posts(Post.query.filter(Post.author_id == user.id)), POST_FIELDS,
+                current_app.config['POSTS_PER_PAGE'], Post.created_at, Post.id)
+
+
+@bp.route('/popular')
+@login_required
+def popular():
+    ranks, keys = PostRank.ranked(request.args.get('sort'))
+    return page(with_posts(ranks.join(Post, PostRank.item)), POST_FIELDS,
+                current_app.config['POSTS_PER_PAGE'], *keys)
+
+
+@bp.route('/posts/<int:id>')
+@login_required
+def post(id):
+    """
+    A post and one page of its comments: top-level ones, or the replies to
+    ?thread=<comment id>. ?fields= selects the post's fields.
+    """
+    names = selected(POST_FIELDS)
+    post = with_posts(Post.query.filter(Post.id == id)).with_entities(
+        *[POST_FIELDS[name] for name in names]).first_or_404()
+
+    thread = request.args.get('thread', type=int)
+    comments = Comment.thread(id).filter(Comment.parent_comment_id == thread).join(
+        User, Comment.author)
+    comments, _, next_url, prev_url = fetch(comments, COMMENT_FIELDS, list(COMMENT_FIELDS),
+                                            current_app.config['COMMENTS_PER_PAGE'],
+                                            Comment.created_at, Comment.id)
+    return respond(dict(post=serialize(POST_FIELDS, names, post), comments=comments,
+                        next=next_url, prev=prev_url))
+
+
+# Chats and users
+
+@bp.route('/chats')
+@login_required
+def chats():
+    ranks, keys = ChatRank.ranked(request.args.get('sort'))
+    return page(ranks.join(Chat, ChatRank.item), CHAT_FIELDS,
+                current_app.config['CHATS_PER_PAGE'], *keys)
+
+
+@bp.route('/leaderboard')
+@login_required
+def leaderboard():
+    ranks, keys = UserRank.ranked(request.args.get('sort'))
+    return page(ranks.join(User, UserRank.item), USER_FIELDS,
+                current_app.config['USERS_PER_PAGE'], *keys)
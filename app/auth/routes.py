@@ -1,7 +1,7 @@
 from flask import render_template, redirect, url_for, flash, request
 from werkzeug.urls import url_parse
 from flask_login import login_user, logout_user, current_user
-from app import db
+from app import db, passwords, login_limiter
 from app.auth import bp
 from app.auth.forms import LoginForm, RegistrationForm, \
     ResetPasswordRequestForm, ResetPasswordForm
@@ -15,10 +15,22 @@ def login():
         return redirect(url_for('main.index'))
     form = LoginForm()
     if form.validate_on_submit():
+        # The per-account bucket is also per address, so failed logins from
+        # elsewhere can't lock a user out
+        address = str(request.remote_addr)
+        account = 'user:{}:{}'.format(address, form.username.data.lower())
+        if not login_limiter.allow('ip:' + address) or not login_limiter.allow(account):
+            flash('Too many login attempts, please try again later')
+            return render_template('auth/login.html', title='Sign In', form=form), 429
         user = User.get_by_username(form.username.data)
+        if user is None:
+            # Same cost as a wrong password, so usernames can't be probed by timing
+            passwords.verify(None, form.password.data)
         if user is None or not user.check_password(form.password.data):
             flash('Invalid username or password')
             return redirect(url_for('auth.login'))
+        login_limiter.reset(account)
+        db.session.commit()
         login_user(user, remember=form.remember_me.data)
         next_page = request.args.get('next')
         if not next_page or url_parse(next_page).netloc != '':
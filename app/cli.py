@@ -9,6 +9,156 @@ def register(app):
         print("initializing database")
         if os.path.exists("app.db"):
             os.remove("app.db")
-        os.system("flask db init")
-        os.system("flask db migrate")
         os.system("flask db upgrade")
+
+    @app.cli.command()
+    def recount():
+        """Rebuild like, follower and score counters."""
+        from app.models import recount
+        print("recounting likes, followers and scores")
+        recount()
+
+    @app.cli.command()
+    def rank():
+        """Rebuild the popular, explore and leaderboard rankings."""
+        from app.models import rebuild_ranks
+        print("rebuilding rankings")
+        rebuild_ranks()
+
+    @app.cli.command()
+    def reindex():
+        """Rebuild the full-text search indexes."""
+        from app import search
+        print("rebuilding search indexes")
+        search.rebuild()
+
+    @app.cli.command()
+    @click.option('--threads', default=None, type=int, help='Number of worker threads.')
+    def worker(threads):
+        """Run background job workers until interrupted."""
+        from app.util.jobs import workers
+        print("starting job workers")
+        workers.start(threads)
+        try:
+            while True:
+                workers.stopped.wait(3600)
+        except KeyboardInterrupt:
+            workers.stop()
+
+    @app.cli.command()
+    @click.option('--prune', default=None, type=int,
+                  help='Also delete finished jobs older than this many seconds.')
+    def jobs(prune):
+        """Show job queue depth."""
+        from app.util import jobs
+        if prune is not None:
+            jobs.prune(prune)
+        for state, value in sorted(jobs.depth().items()):
+            print("{}: {}".format(state, value))
+
+    @app.cli.command('perf-report')
+    def perf_report():
+        """Print per-endpoint request timings as JSON."""
+        import json
+        from app import perf
+        print(json.dumps(perf.collect(), indent=2, sort_keys=True))
+
+    @app.cli.command()
+    @click.option('--users', default=1000)
+    @click.option('--chats', default=50)
+    @click.option('--follows', default=10, help='Chats followed per user.')
+    @click.option('--posts', default=20000)
+    @click.option('--likes', default=100000)
+    @click.option('--comments', default=50000)
+    @click.option('--skew', default=1.1, help='Zipf exponent for popularity.')
+    @click.option('--seed', 'random_seed', default=0, help='Random seed.')
+    def seed(users, chats, follows, posts, likes, comments, skew, random_seed):
+        """Bulk-generate synthetic users, chats, posts, likes and comments."""
+        from app.util.seed import seed
+        print("seeding database")
+        counts = seed(users=users, chats=chats, follows=follows, posts=posts, likes=likes,
+                      comments=comments, skew=skew, random_seed=random_seed)
+        for name, value in counts.items():
+            print("{}: {}".format(name, value))
+
+    @app.cli.command()
+    @click.option('--days', type=int, help='Archive posts older than this (default ARCHIVE_AFTER_DAYS).')
+    @click.option('--batch-size', type=int, help='Posts moved per transaction.')
+    @click.option('--max-batches', type=int, help='Stop after this many batches.')
+    @click.option('--pause', default=0.0, help='Seconds to sleep between batches.')
+    def archive(days, batch_size, max_batches, pause):
+        """Move old posts, with their comments and likes, to the archive tables."""
+        import time
+        from datetime import datetime, timedelta
+        from app.models import archive_posts
+        days = days if days is not None else app.config['ARCHIVE_AFTER_DAYS']
+        before = datetime.utcnow() - timedelta(days=days)
+        total = batches = 0
+        while max_batches is None or batches < max_batches:
+            moved = archive_posts(batch_size=batch_size, before=before)
+            if not moved:
+                break
+            total += moved
+            batches += 1
+            print("archived {} posts".format(total))
+            time.sleep(pause)
+        print("done, {} posts archived".format(total))
+
+    @app.cli.command('export')
+    @click.argument('path')
+    @click.option('--chunk-size', default=5000, help='Rows fetched per round trip.')
+    def export_data(path, chunk_size):
+        """Write users, chats, posts and the rest as NDJSON (.gz/.zst to compress)."""
+        from app.util.transfer import export
+        for name, value in export(path, chunk_size=chunk_size).items():
+            click.echo("{}: {}".format(name, value), err=True)
+
+    @app.cli.command('import')
+    @click.argument('path')
+    @click.option('--chunk-size', default=5000, help='Rows inserted per transaction.')
+    @click.option('--restart', is_flag=True, help='Ignore any checkpoint from an earlier run.')
+    def import_data(path, chunk_size, restart):
+        """Load an NDJSON export, resuming from its checkpoint if interrupted."""
+        from app.util.transfer import import_
+        checkpoint = (path if path != '-' else 'stdin') + '.checkpoint'
+        if restart and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        for name, value in import_(path, chunk_size=chunk_size, checkpoint=checkpoint).items():
+            print("{}: {}".format(name, value))
+
+    @app.cli.command()
+    @click.option('--repeat', default=20, help='Timed requests per route.')
+    @click.option('--output', type=click.File('w'), default='-', help='Where to write the JSON.')
+    def bench(repeat, output):
+        """Time the main pages and count their queries."""
+        import json
+        from app.util.bench import run
+        json.dump(run(repeat=repeat), output, indent=2, sort_keys=True)
+        output.write('\n')
+
+    @app.cli.command('bench-startup')
+    @click.option('--repeat', default=5, help='Cold imports to take the best of.')
+    @click.option('--top', default=25, help='How many of the slowest modules to list.')
+    @click.option('--output', type=click.File('w'), default='-', help='Where to write the JSON.')
+    def bench_startup(repeat, top, output):
+        """Time a cold import of the app, per module."""
+        import json
+        from app.util.bench import startup
+        json.dump(startup(repeat=repeat, top=top), output, indent=2)
+        output.write('\n')
+
+    @app.cli.command()
+    def templates():
+        """Compile every template into the bytecode cache."""
+        env = app.jinja_env
+        names = env.list_templates()
+        for name in names:
+            env.get_template(name)
+        print("compiled {} templates into {}".format(len(names), app.config['TEMPLATE_CACHE_DIR']))
+
+    @app.cli.command()
+    def timelines():
+        """Rebuild every user's home feed timeline."""
+        from app.models import rebuild_timelines
+        print("rebuilding timelines")
+        rebuild_timelines()
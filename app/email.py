@@ -1,17 +1,19 @@
-from threading import Thread
 from flask import current_app
-from flask_mail import Message
 from app import mail
+from app.util.jobs import task, enqueue
 
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
-
-
-def send_email(subject, sender, recipients, text_body, html_body):
+@task
+def deliver_email(subject, sender, recipients, text_body, html_body):
+    from flask_mail import Message
     msg = Message(subject, sender=sender, recipients=recipients)
     msg.body = text_body
     msg.html = html_body
-    Thread(target=send_async_email,
-           args=(current_app._get_current_object(), msg)).start()
+    if 'mail' not in current_app.extensions:
+        mail.init_app(current_app)
+    mail.send(msg)
+
+
+def send_email(subject, sender, recipients, text_body, html_body):
+    enqueue('deliver_email', dict(subject=subject, sender=sender, recipients=recipients,
+                                  text_body=text_body, html_body=html_body))
@@ -5,6 +5,7 @@ from flask_wtf.file import FileAllowed
 from wtforms.validators import ValidationError, DataRequired, Length
 from app.models import User, Chat
 from app import db, images
+from app.util import images as pipeline
 
 
 class EditProfileForm(FlaskForm):
@@ -24,6 +25,16 @@ class PostForm(FlaskForm):
         super(PostForm, self).__init__(*args, **kwargs)
         self.chat_name.choices = [(c[0], c[0]) for c in db.session.query(Chat.name).all()]
 
+    def validate_image(self, image):
+        if not image.data:
+            return
+        try:
+            pipeline.check(image.data)
+        except pipeline.ImageTooLarge:
+            raise ValidationError('That image is too large.')
+        except ValueError:
+            raise ValidationError("That image couldn't be read.")
+
 
 class CommentForm(FlaskForm):
     body = TextAreaField('Comment', validators=[DataRequired()])
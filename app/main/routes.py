@@ -1,31 +1,64 @@
-from datetime import datetime
 from flask import render_template, flash, redirect, url_for, request, g, \
-    jsonify, current_app
+    jsonify, current_app, abort, make_response
 from flask_login import current_user, login_required
 from app import db
-from sqlalchemy import func
 from app.main.forms import EditProfileForm, PostForm, ChatForm, CommentForm, EditChatForm, SearchForm
-from app.models import User, Post, Image, Chat, Comment, followers, Like
+from app.models import User, Post, Chat, Comment, \
+    PostRank, ChatRank, UserRank, Timeline, ArchivedPost, ArchivedComment, latest
 from app.main import bp
-from app import Config, images
+from app.util.pagination import paginate, page_query, encode_cursor
+from app.util import images as pipeline
+from app.util.events import publish, recent, CHANNEL
+from app.util.conditional import Conditional
+from app.util.routing import read_primary
+from app.util.filters import censor
+from app import Config, search, activity, avatars, perf
 import os
+import re
 
 
 @bp.before_app_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        activity.touch(current_user.id)
+
+
+def viewer_state(posts=(), chats=()):
+    """
+    Look up which of a page's posts and chats the current user has liked or
+    follows, so templates don't query once per item
+    """
+    if not current_user.is_authenticated:
+        return dict(liked=set(), following=set())
+    return dict(liked=current_user.liked_ids([post.id for post in posts]),
+                following=current_user.following_ids([chat.id for chat in chats]))
+
+
+def state_versions(state):
+    """
+    viewer_state() in a form Conditional can hash, since the Like and Follow
+    buttons change with it
+    """
+    return sorted(state['liked']), sorted(state['following'])
 
 
-def paginate(items, per_page):
-    page = request.args.get('page', 1, type=int)
+def row_times(rows):
+    """
+    Every change time in rows from Post.versions, for a page's validator
+    """
+    return [time for row in rows for time in (row.updated_at, row.attachment_updated_at)]
 
-    items = items.paginate(page, per_page, False)
 
-    next_url = url_for(request.endpoint, page=items.next_num) if items.has_next else None
-    prev_url = url_for(request.endpoint, page=items.prev_num) if items.has_prev else None
-    return items, next_url, prev_url
+def search_terms(form):
+    """
+    Search terms from a submitted search form, or from ?q= on the links to
+    further pages of results
+    """
+    if form.validate_on_submit():
+        return form.search.data
+    if request.args.get('q'):
+        form.search.data = request.args['q']
+    return request.args.get('q')
 
 
 # Front pages
@@ -34,65 +67,82 @@ def paginate(items, per_page):
 @bp.route('/index')
 @login_required
 def index():
-    posts = current_user.followed_posts()
-    posts, next_url, prev_url = paginate(posts, current_app.config['POSTS_PER_PAGE'])
+    per_page = current_app.config['POSTS_PER_PAGE']
+    if request.args.get('source') == 'followed':
+        # Past the end of the stored timeline: read followed chats directly
+        posts, next_url, prev_url = paginate(current_user.followed_posts(), per_page,
+                                             Post.created_at, Post.id)
+    else:
+        posts, keys = current_user.timeline()
+        posts, next_url, prev_url = paginate(posts, per_page, *keys, attrs=('created_at', 'id'))
+        if next_url is None and posts and current_user.has_older_posts(posts[-1].created_at, posts[-1].id):
+            next_url = url_for('main.index', source='followed',
+                               after=encode_cursor([posts[-1].created_at, posts[-1].id]))
 
     return render_template('index.html', title='Home',
-                           posts=posts.items, next_url=next_url, prev_url=prev_url,
-                           include_chat=True)
+                           posts=posts, next_url=next_url, prev_url=prev_url,
+                           include_chat=True, **viewer_state(posts=posts))
 
 
 @bp.route('/explore_chats', methods=['GET', 'POST'])
 @login_required
 def explore_chats():
     form = SearchForm()
-    chats = db.session.query(Chat)
-
-    if form.validate_on_submit():
-        chats = chats.filter(Chat.name.like('%' + form.search.data + '%') |
-                             Chat.about.like('%' + form.search.data + '%'))
+    highlights = {}
+    terms = search_terms(form)
 
-    chats = chats.join(followers).group_by(Chat.id).order_by(func.count().desc())
-    chats, next_url, prev_url = paginate(chats, current_app.config['CHATS_PER_PAGE'])
+    if terms:
+        chats, highlights, next_url, prev_url = search.lookup(
+            Chat.query, Chat, terms, current_app.config['CHATS_PER_PAGE'])
+    else:
+        ranks, keys = ChatRank.ranked(request.args.get('sort'))
+        ranks, next_url, prev_url = paginate(ranks, current_app.config['CHATS_PER_PAGE'], *keys)
+        chats = [rank.item for rank in ranks]
 
     return render_template('explore_chats.html', title='Explore',
-                           chats=chats.items, next_url=next_url, prev_url=prev_url,
-                           form=form)
+                           chats=chats, next_url=next_url, prev_url=prev_url,
+                           form=form, highlights=highlights, **viewer_state(chats=chats))
 
 
 @bp.route('/popular', methods=['GET', 'POST'])
 @login_required
 def popular():
     search_form = SearchForm()
-    posts = db.session.query(Post)
-
-    if search_form.validate_on_submit():
-        posts = posts.filter(Post.title.like('%' + search_form.search.data + '%') |
-                             Post.body.like('%' + search_form.search.data + '%'))
+    highlights = {}
+    terms = search_terms(search_form)
 
-    posts = posts.join(Like).group_by(Post.id).order_by(func.count().desc())
-    posts, next_url, prev_url = paginate(posts, current_app.config['POSTS_PER_PAGE'])
+    if terms:
+        posts, highlights, next_url, prev_url = search.lookup(
+            Post.feed(), Post, terms, current_app.config['POSTS_PER_PAGE'])
+    else:
+        ranks, keys = PostRank.ranked(request.args.get('sort'))
+        ranks, next_url, prev_url = paginate(ranks, current_app.config['POSTS_PER_PAGE'], *keys)
+        posts = [rank.item for rank in ranks]
 
     return render_template('popular.html', title='Popular',
-                           posts=posts.items, next_url=next_url, prev_url=prev_url,
-                           form=search_form, include_chat=True)
+                           posts=posts, next_url=next_url, prev_url=prev_url,
+                           form=search_form, include_chat=True, highlights=highlights,
+                           **viewer_state(posts=posts))
 
 
 @bp.route('/leaderboard', methods=['GET', 'POST'])
 @login_required
 def leaderboard():
     search_form = SearchForm()
-    users = db.session.query(User)
+    highlights = {}
+    terms = search_terms(search_form)
 
-    if search_form.validate_on_submit():
-        users = users.filter(User.username.like('%' + search_form.search.data + '%'))
-
-    users = users.join(Post).join(Like).group_by(User.id).order_by(func.count().desc())
-    users, next_url, prev_url = paginate(users, current_app.config['USERS_PER_PAGE'])
+    if terms:
+        users, highlights, next_url, prev_url = search.lookup(
+            User.query, User, terms, current_app.config['USERS_PER_PAGE'])
+    else:
+        ranks, keys = UserRank.ranked(request.args.get('sort'))
+        ranks, next_url, prev_url = paginate(ranks, current_app.config['USERS_PER_PAGE'], *keys)
+        users = [rank.item for rank in ranks]
 
     return render_template('leaderboard.html', title='Leaderboard',
-                           users=users.items, next_url=next_url, prev_url=prev_url,
-                           form=search_form)
+                           users=users, next_url=next_url, prev_url=prev_url,
+                           form=search_form, highlights=highlights)
 
 
 # Chats
@@ -101,12 +151,22 @@ def leaderboard():
 @login_required
 def show_chat(name):
     chat = Chat.query.filter_by(name=name).first_or_404()
+    per_page = current_app.config['POSTS_PER_PAGE']
+    rows = page_query(Post.versions(Post.chat_id == chat.id), per_page,
+                      Post.created_at, Post.id).all()
+    state = viewer_state(posts=rows, chats=[chat])
+    page = Conditional(latest(chat.updated_at, *row_times(rows)), chat.follower_count,
+                       [list(row) for row in rows], *state_versions(state))
+    not_modified = page.not_modified()
+    if not_modified is not None:
+        return not_modified
 
-    posts = Post.query.filter_by(chat=chat).order_by(Post.created_at.desc())
-    posts, next_url, prev_url = paginate(posts, current_app.config['POSTS_PER_PAGE'])
+    posts = Post.feed().filter(Post.chat_id == chat.id)
+    posts, next_url, prev_url = paginate(posts, per_page, Post.created_at, Post.id)
 
-    return render_template('chat.html', title=chat.name, chat=chat,
-                           posts=posts.items, next_url=next_url, prev_url=prev_url)
+    return page.apply(render_template('chat.html', title=chat.name, chat=chat,
+                                      posts=posts, next_url=next_url, prev_url=prev_url,
+                                      **state))
 
 
 @bp.route('/create_chat', methods=['GET', 'POST'])
@@ -138,13 +198,18 @@ def make_post(chat_name):
         new_post = Post(title=form.title.data, body=form.body.data, author=current_user)
         new_post.chat = Chat.query.filter_by(name=chat_name).first()
 
+        upload = None
         if 'image' in request.files and request.files['image']:
-            filename = images.save(form.image.data)
-            url = images.url(filename)
-            image = Image(filename=filename, url=url)
-            new_post.attachment = image
+            new_post.attachment, upload = pipeline.store(form.image.data)
 
         db.session.add(new_post)
+        db.session.flush()
+        Timeline.fan_out(new_post)
+        publish('chat:{}'.format(new_post.chat_id), 'post', id=new_post.id,
+                title=censor(new_post.title), author=current_user.username,
+                url=url_for('main.show_post', id=new_post.id))
+        if upload:
+            pipeline.schedule(new_post.attachment, upload)
         db.session.commit()
         flash('Your post is now live!')
         return redirect(url_for('main.show_chat', name=chat_name))
@@ -154,23 +219,64 @@ def make_post(chat_name):
 @bp.route('/post/<id>', methods=['GET', 'POST'])
 @login_required
 def show_post(id):
-    post = Post.query.filter_by(id=id).first_or_404()
+    post = Post.feed().filter_by(id=id).first()
+    if post is None:
+        return show_archived_post(id)
 
     form = CommentForm()
     if form.validate_on_submit():
         comment = Comment(body=form.body.data, author=current_user)
         comment.post = post
         db.session.add(comment)
+        db.session.flush()
+        publish('post:{}'.format(post.id), 'comment', id=comment.id,
+                parent=comment.parent_comment_id, author=current_user.username,
+                body=comment.body)
         db.session.commit()
         flash('Your comment is now live!')
         return redirect(url_for('main.show_post', id=id))
 
-    comments = Comment.query.filter_by(post_id=id).order_by(Comment.created_at.desc())
-    comments, next_url, prev_url = paginate(comments, current_app.config['COMMENTS_PER_PAGE'])
-
-    return render_template('post.html', title=post.title, post=post,
-                           comments=comments.items, next_url=next_url, prev_url=prev_url,
-                           form=form)
+    changed, count = Comment.version(post.id)
+    state = viewer_state(posts=[post])
+    page = Conditional(latest(post.updated_at, post.attachment and post.attachment.updated_at,
+                              changed), count, post.like_count, *state_versions(state))
+    not_modified = page.not_modified()
+    if not_modified is not None:
+        return not_modified
+
+    # Page through one level of the tree: top-level comments, or the replies
+    # to ?thread=<comment id> when following a "more replies" link
+    thread = request.args.get('thread', type=int)
+    comments = Comment.thread(post.id).filter(Comment.parent_comment_id == thread)
+    comments, next_url, prev_url = paginate(comments, current_app.config['COMMENTS_PER_PAGE'],
+                                            Comment.created_at, Comment.id)
+    Comment.load_replies(comments, current_app.config['COMMENT_MAX_DEPTH'])
+
+    return page.apply(render_template('post.html', title=post.title, post=post,
+                                      comments=comments, next_url=next_url, prev_url=prev_url,
+                                      form=form, thread=thread, **state))
+
+
+def show_archived_post(id):
+    """
+    Read-only view of a post moved to the archive by `flask archive`
+    """
+    post = ArchivedPost.feed().filter_by(id=id).first_or_404()
+    # Archived posts never change, likes included
+    page = Conditional(post.updated_at, last_modified=post.updated_at)
+    not_modified = page.not_modified()
+    if not_modified is not None:
+        return not_modified
+
+    thread = request.args.get('thread', type=int)
+    comments = ArchivedComment.thread(post.id).filter(ArchivedComment.parent_comment_id == thread)
+    comments, next_url, prev_url = paginate(comments, current_app.config['COMMENTS_PER_PAGE'],
+                                            ArchivedComment.created_at, ArchivedComment.id)
+    ArchivedComment.load_replies(comments)
+
+    return page.apply(render_template('post.html', title=post.title, post=post,
+                                      comments=comments, next_url=next_url, prev_url=prev_url,
+                                      form=None, thread=thread, **viewer_state()))
 
 
 # Users
@@ -178,13 +284,53 @@ def show_post(id):
 @bp.route('/user/<username>')
 def show_user(username):
     user = User.query.filter_by(username=username).first_or_404()
-
-    posts = Post.query.filter_by(author=user).order_by(Post.created_at.desc())
-    posts, next_url, prev_url = paginate(posts, current_app.config['POSTS_PER_PAGE'])
-
-    return render_template('user.html', user=user,
-                           posts=posts.items, next_url=next_url, prev_url=prev_url,
-                           include_chat=True)
+    per_page = current_app.config['POSTS_PER_PAGE']
+    archive = request.args.get('source') == 'archive'
+    model = ArchivedPost if archive else Post
+    rows = page_query(model.versions(model.author_id == user.id), per_page,
+                      model.created_at, model.id).all()
+    state = viewer_state(posts=rows)
+    page = Conditional(latest(user.updated_at, *row_times(rows)), user.score,
+                       [list(row) for row in rows], *state_versions(state))
+    not_modified = page.not_modified()
+    if not_modified is not None:
+        return not_modified
+
+    if archive:
+        # Archived posts are all older than the live ones, so they follow them
+        posts = ArchivedPost.feed().filter(ArchivedPost.author_id == user.id)
+        posts, next_url, prev_url = paginate(posts, per_page,
+                                             ArchivedPost.created_at, ArchivedPost.id)
+    else:
+        posts = Post.feed().filter(Post.author_id == user.id)
+        posts, next_url, prev_url = paginate(posts, per_page, Post.created_at, Post.id)
+        if next_url is None and user.has_archived_posts():
+            next_url = url_for('main.show_user', username=user.username, source='archive')
+
+    return page.apply(render_template('user.html', user=user,
+                                      posts=posts, next_url=next_url, prev_url=prev_url,
+                                      include_chat=True, **state))
+
+
+@bp.route('/avatar/<digest>/<int:size>')
+def avatar(digest, size):
+    if not re.fullmatch('[0-9a-f]{32}', digest):
+        abort(404)
+    # Only the sizes the templates use are drawn. Every well-formed digest
+    # gets its identicon, so the response doesn't reveal whether an email is
+    # registered, but only users' digests are stored, so arbitrary URLs can't
+    # fill the disk
+    if size not in current_app.config['AVATAR_SIZES']:
+        abort(404)
+    data = avatars.get(digest, size, known=lambda digest: db.session.query(
+        User.query.filter_by(avatar_digest=digest).exists()).scalar())
+
+    response = make_response(data)
+    response.mimetype = 'image/png'
+    response.set_etag('{}-{}'.format(digest, size))
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config['AVATAR_MAX_AGE']
+    return response.make_conditional(request)
 
 
 @bp.route('/edit_profile', methods=['GET', 'POST'])
@@ -204,6 +350,7 @@ def edit_profile():
 
 @bp.route('/follow/<name>')
 @login_required
+@read_primary
 def follow(name):
     the_chat = Chat.query.filter_by(name=name).first()
     if the_chat is None:
@@ -217,6 +364,7 @@ def follow(name):
 
 @bp.route('/unfollow/<name>')
 @login_required
+@read_primary
 def unfollow(name):
     the_chat = Chat.query.filter_by(name=name).first()
     if the_chat is None:
@@ -230,12 +378,15 @@ def unfollow(name):
 
 @bp.route('/like/<post_id>')
 @login_required
+@read_primary
 def like(post_id):
     the_post = Post.query.filter_by(id=post_id).first()
     if the_post is None:
         flash('Post {} not found.'.format(post_id))
         return redirect(url_for('main.index'))
     current_user.like(the_post)
+    db.session.flush()
+    publish('post:{}'.format(the_post.id), 'likes', id=the_post.id, count=the_post.like_count)
     db.session.commit()
     flash('You liked the post!')
     return redirect(request.referrer or url_for('main.show_post', id=post_id))
@@ -243,17 +394,53 @@ def like(post_id):
 
 @bp.route('/unlike/<post_id>')
 @login_required
+@read_primary
 def unlike(post_id):
     the_post = Post.query.filter_by(id=post_id).first()
     if the_post is None:
         flash('Post {} not found.'.format(post_id))
         return redirect(url_for('main.index'))
     current_user.unlike(the_post)
+    db.session.flush()
+    publish('post:{}'.format(the_post.id), 'likes', id=the_post.id, count=the_post.like_count)
     db.session.commit()
     flash('You unliked the post!')
     return redirect(request.referrer or url_for('main.show_post', id=post_id))
 
 
+# Live updates
+
+@bp.route('/events')
+@login_required
+def events():
+    """
+    Events for ?channel=chat:<id> (new posts) and ?channel=post:<id> (new
+    comments and like counts) since the cursor from the previous poll
+    """
+    channels = request.args.getlist('channel')
+    if not channels or len(channels) > current_app.config['EVENTS_MAX_CHANNELS'] or \
+            not all(CHANNEL.match(channel) for channel in channels):
+        abort(400)
+    try:
+        items, cursor = recent(channels, request.args.get('since', type=float))
+    except ValueError:
+        abort(400)
+    response = jsonify(events=items, cursor=cursor,
+                       interval=current_app.config['EVENTS_POLL_INTERVAL'])
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+# Admin
+
+@bp.route('/admin/perf')
+@login_required
+def perf_report():
+    if current_user.email not in current_app.config['ADMINS']:
+        abort(404)
+    return jsonify(perf.collect())
+
+
 # Editing chats
 
 @bp.route('/edit_chat/<name>', methods=['GET', 'POST'])
@@ -1,16 +1,24 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 from hashlib import md5
 from time import time
+import math
 from flask import current_app, url_for, escape
 from flask_login import UserMixin, current_user
-from sqlalchemy import func
+from sqlalchemy import func, literal, tuple_
+from sqlalchemy.orm import joinedload, validates
 from sqlalchemy.ext.hybrid import hybrid_property
-from werkzeug.security import generate_password_hash, check_password_hash
+import json
 import jwt
 import os
 
 from app.util.filters import nl2br
-from app import db, login, basedir, Config
+from app.util.jobs import task, enqueue
+from app.util.transfer import insert_ignoring
+from app import db, login, basedir, Config, images, passwords
+
+
+def latest(*times):
+    return max((t for t in times if t is not None), default=None)
 
 
 class Base(db.Model):
@@ -19,12 +27,33 @@ class Base(db.Model):
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
 
+def increment(obj, column, delta):
+    """
+    Adjust a denormalized counter column on obj by delta. Persistent rows get
+    an atomic `column = column + delta` in the UPDATE, so concurrent requests
+    can't lose each other's increments; pending rows are adjusted in Python.
+
+    A counter change isn't an edit, so the UPDATE keeps updated_at as it is
+    rather than letting onupdate bump it (it drives the fragment cache keys
+    and page validators).
+    """
+    if obj.id is None:
+        setattr(obj, column.key, (getattr(obj, column.key) or 0) + delta)
+    else:
+        setattr(obj, column.key, column + delta)
+        obj.updated_at = type(obj).updated_at
+
+
 # Followers
 
 followers = db.Table(
     'followers',
     db.Column('user_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('chat_id', db.Integer, db.ForeignKey('chat.id'))
+    db.Column('chat_id', db.Integer, db.ForeignKey('chat.id')),
+    # One row per pair; serves is_following and the home feed join
+    db.Index('ux_followers_user_id_chat_id', 'user_id', 'chat_id', unique=True),
+    # Follower lookups per chat
+    db.Index('ix_followers_chat_id_user_id', 'chat_id', 'user_id'),
 )
 
 
@@ -38,6 +67,11 @@ class Like(Base):
     post_id = db.Column(db.Integer, db.ForeignKey('post.id'), primary_key=True)
     liked = db.Column(db.Boolean)
 
+    __table_args__ = (
+        # The primary key leads with user_id; this covers per-post lookups
+        db.Index('ix_like_post_id_user_id', 'post_id', 'user_id'),
+    )
+
 
 # Users
 
@@ -51,12 +85,16 @@ class User(UserMixin, Base):
 
     # User email information
     email = db.Column(db.String(255), nullable=False, unique=True)
+    avatar_digest = db.Column(db.String(32), index=True)
     confirmed_at = db.Column(db.DateTime())
 
     # User information
     about_me = db.Column(db.String(140))
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
 
+    # Total likes received on this user's posts, kept in sync by like/unlike
+    score = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
     posts = db.relationship('Post', backref='author', lazy='dynamic')
     comments = db.relationship('Comment', backref='author', lazy='dynamic')
     chats = db.relationship('Chat', backref='creator', lazy='dynamic')
@@ -76,57 +114,127 @@ class User(UserMixin, Base):
     def about_me_e(self):
         return nl2br(str(escape(self.about_me)))
 
-    def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(
-            digest, size)
+    @validates('email')
+    def validate_email(self, key, email):
+        self.avatar_digest = md5(email.lower().encode('utf-8')).hexdigest()
+        return email
 
-    def score(self):
-        score = 0
-        for post in self.posts:
-            score += post.liked_by.count()
-        return score
+    def avatar(self, size):
+        return url_for('main.avatar', digest=self.avatar_digest, size=size)
 
     # Liking posts
 
     def like(self, post):
         if not self.has_liked(post):
             self.likes.append(post)
+            increment(post, Post.like_count, 1)
+            increment(post.author, User.score, 1)
+            PostRank.bump(post, 1)
+            UserRank.bump(post.author, 1)
 
     def unlike(self, post):
         if self.has_liked(post):
             self.likes.remove(post)
+            increment(post, Post.like_count, -1)
+            increment(post.author, User.score, -1)
+            PostRank.bump(post, -1)
+            UserRank.bump(post.author, -1)
 
     def has_liked(self, post):
         return self.likes.filter(Like.post_id == post.id).scalar() is not None
 
+    def liked_ids(self, post_ids):
+        """
+        Return the subset of post_ids this user has liked, in one query
+        """
+        if not post_ids:
+            return set()
+        rows = db.session.query(Like.post_id).filter(
+            Like.user_id == self.id, Like.post_id.in_(post_ids))
+        return {post_id for post_id, in rows}
+
     # Following chats
 
     def follow(self, chat):
         if not self.is_following(chat):
             self.following.append(chat)
+            increment(chat, Chat.follower_count, 1)
+            ChatRank.bump(chat, 1)
+            Timeline.backfill(self, chat)
 
     def unfollow(self, chat):
         if self.is_following(chat):
             self.following.remove(chat)
+            increment(chat, Chat.follower_count, -1)
+            ChatRank.bump(chat, -1)
+            Timeline.remove(self, chat)
 
     def is_following(self, chat):
         return self.following.filter(
             followers.c.chat_id == chat.id).scalar() is not None
 
+    def following_ids(self, chat_ids):
+        """
+        Return the subset of chat_ids this user follows, in one query
+        """
+        if not chat_ids:
+            return set()
+        rows = db.session.query(followers.c.chat_id).filter(
+            followers.c.user_id == self.id, followers.c.chat_id.in_(chat_ids))
+        return {chat_id for chat_id, in rows}
+
     def followed_posts(self):
-        followed = Post.query.join(
+        followed = Post.feed().join(
             followers, (followers.c.chat_id == Post.chat_id)).filter(
             followers.c.user_id == self.id)
-        return followed.order_by(Post.created_at.desc())
+        return followed
+
+    def has_archived_posts(self):
+        posts = ArchivedPost.query.filter(ArchivedPost.author_id == self.id)
+        return db.session.query(posts.exists()).scalar()
+
+    def timeline(self):
+        """
+        Return the home feed query and its keyset pagination keys. Normally a
+        range scan of this user's precomputed Timeline rows; followed chats
+        too big to fan out to are merged in at read time.
+        """
+        huge = [chat_id for chat_id, in db.session.query(followers.c.chat_id).join(
+            Chat, Chat.id == followers.c.chat_id).filter(
+            followers.c.user_id == self.id,
+            Chat.follower_count > current_app.config['TIMELINE_FANOUT_LIMIT'])]
+        if not huge:
+            return Post.feed().join(Timeline, Timeline.post_id == Post.id).filter(
+                Timeline.user_id == self.id), (Timeline.created_at, Timeline.post_id)
+
+        fanned_out = db.session.query(Timeline.post_id).filter(Timeline.user_id == self.id)
+        return Post.feed().filter(Post.id.in_(fanned_out) | Post.chat_id.in_(huge)), \
+            (Post.created_at, Post.id)
+
+    def has_older_posts(self, created_at, id):
+        """
+        Whether any followed chat has posts before (created_at, id), including
+        ones trimmed from the timeline
+        """
+        older = self.followed_posts().filter(
+            tuple_(Post.created_at, Post.id) < tuple_(created_at, id))
+        return db.session.query(older.exists()).scalar()
 
     # Authentication
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = passwords.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        """
+        Verify password, upgrading the stored hash if it was made with old
+        parameters (the caller commits)
+        """
+        if not passwords.verify(self.password_hash, password):
+            return False
+        if passwords.needs_rehash(self.password_hash):
+            self.set_password(password)
+        return True
 
     def get_reset_password_token(self, expires_in=600):
         return jwt.encode(
@@ -152,6 +260,11 @@ class User(UserMixin, Base):
         return User.query.filter(func.lower(User.email) == func.lower(email)).first()
 
 
+# Case-insensitive lookups in get_by_username/get_by_email
+db.Index('ix_user_username_lower', func.lower(User.username))
+db.Index('ix_user_email_lower', func.lower(User.email))
+
+
 @login.user_loader
 def load_user(id):
     return User.query.get(int(id))
@@ -160,6 +273,8 @@ def load_user(id):
 # Posts
 
 class Post(Base):
+    archived = False
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(128))
     body = db.Column(db.String(2048))
@@ -167,10 +282,22 @@ class Post(Base):
     author_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     chat_id = db.Column(db.Integer, db.ForeignKey('chat.id'))
 
+    like_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
     comments = db.relationship('Comment', backref='post')
 
     attachment = db.relationship('Image', uselist=False, backref='post')
 
+    # Keyset pagination orders: (created_at, id) within a chat, an author,
+    # or across followed chats. AUTOINCREMENT keeps SQLite from handing out
+    # the ids of posts moved to the archive again.
+    __table_args__ = (
+        db.Index('ix_post_chat_id_created_at', 'chat_id', 'created_at', 'id'),
+        db.Index('ix_post_author_id_created_at', 'author_id', 'created_at', 'id'),
+        db.Index('ix_post_created_at', 'created_at', 'id'),
+        {'sqlite_autoincrement': True},
+    )
+
     def __repr__(self):
         return '<Post {}>'.format(self.body)
 
@@ -178,6 +305,122 @@ class Post(Base):
     def body_e(self):
         return nl2br(str(escape(self.body)))
 
+    @staticmethod
+    def feed():
+        """
+        Base query for any page that renders _post.html, with the author, chat
+        and attachment loaded in the same SELECT as the posts
+        """
+        return Post.query.options(
+            joinedload(Post.author),
+            joinedload(Post.chat),
+            joinedload(Post.attachment))
+
+    @staticmethod
+    def versions(*criterion):
+        """
+        Query for what a rendered post changes with (its edits, like count
+        and attachment) over the posts matching criterion, so conditional
+        GETs can validate a page's rows without loading them
+        """
+        return db.session.query(Post.id, Post.updated_at, Post.like_count,
+                                Image.updated_at.label('attachment_updated_at')).outerjoin(
+            Post.attachment).filter(*criterion)
+
+
+class Timeline(db.Model):
+    """
+    Precomputed home feed: one row per (user, post in a followed chat),
+    written when the post is made (fan-out on write) and trimmed to the
+    newest TIMELINE_LENGTH rows per user
+    """
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), primary_key=True)
+    # Copy of post.created_at so the feed is a range scan of the index below
+    created_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_timeline_user_id_created_at', 'user_id', 'created_at', 'post_id'),
+    )
+
+    @staticmethod
+    def fan_out(post):
+        """
+        Add a new (flushed) post to the timeline of every follower of its
+        chat, unless the chat has too many followers to write to. Nothing is
+        committed: the rows and the trim job go out with the post.
+        """
+        if post.chat.follower_count > current_app.config['TIMELINE_FANOUT_LIMIT']:
+            return
+        rows = db.select([followers.c.user_id, literal(post.id), literal(post.created_at)]).where(
+            followers.c.chat_id == post.chat_id)
+        db.session.execute(Timeline.__table__.insert().from_select(
+            ['user_id', 'post_id', 'created_at'], rows))
+        enqueue('trim_timelines', key='trim_timelines',
+                delay=current_app.config['TIMELINE_TRIM_DELAY'])
+
+    @staticmethod
+    def backfill(user, chat):
+        """
+        Copy a newly followed chat's recent posts into user's timeline
+        """
+        if user.id is None or chat.id is None or \
+                chat.follower_count > current_app.config['TIMELINE_FANOUT_LIMIT']:
+            return
+        existing = db.session.query(Timeline.post_id).filter(Timeline.user_id == user.id)
+        recent = db.select([literal(user.id), Post.id, Post.created_at]).where(
+            (Post.chat_id == chat.id) & ~Post.id.in_(existing)).order_by(
+            Post.created_at.desc()).limit(current_app.config['TIMELINE_LENGTH'])
+        db.session.execute(Timeline.__table__.insert().from_select(
+            ['user_id', 'post_id', 'created_at'], recent))
+
+    @staticmethod
+    def remove(user, chat):
+        posts = db.session.query(Post.id).filter(Post.chat_id == chat.id)
+        Timeline.query.filter(Timeline.user_id == user.id, Timeline.post_id.in_(posts)).delete(
+            synchronize_session=False)
+
+
+@task
+def trim_timelines():
+    """
+    Drop timeline rows past the newest TIMELINE_LENGTH for each user
+    """
+    length = current_app.config['TIMELINE_LENGTH']
+    over = db.session.query(Timeline.user_id).group_by(Timeline.user_id).having(
+        func.count() > length)
+    for user_id, in over.all():
+        oldest_kept = db.session.query(Timeline.created_at, Timeline.post_id).filter(
+            Timeline.user_id == user_id).order_by(
+            Timeline.created_at.desc(), Timeline.post_id.desc()).offset(length - 1).first()
+        Timeline.query.filter(
+            Timeline.user_id == user_id,
+            tuple_(Timeline.created_at, Timeline.post_id) < tuple_(*oldest_kept)).delete(
+            synchronize_session=False)
+        db.session.commit()
+
+
+@task
+def rebuild_timelines():
+    """
+    Recompute every timeline from followers and posts
+    """
+    Timeline.query.delete()
+    # Number each user's posts newest first and keep only the first
+    # TIMELINE_LENGTH, rather than inserting everything and trimming
+    position = func.row_number().over(
+        partition_by=followers.c.user_id, order_by=(Post.created_at.desc(), Post.id.desc()))
+    ranked = db.select([followers.c.user_id, Post.id.label('post_id'), Post.created_at,
+                        position.label('position')]).select_from(
+        followers.join(Post, Post.chat_id == followers.c.chat_id).join(
+            Chat, Chat.id == Post.chat_id)).where(
+        Chat.follower_count <= current_app.config['TIMELINE_FANOUT_LIMIT']).alias()
+    rows = db.select([ranked.c.user_id, ranked.c.post_id, ranked.c.created_at]).where(
+        ranked.c.position <= current_app.config['TIMELINE_LENGTH'])
+    db.session.execute(Timeline.__table__.insert().from_select(
+        ['user_id', 'post_id', 'created_at'], rows))
+    db.session.commit()
+
 
 class Comment(Base):
     id = db.Column(db.Integer, primary_key=True)
@@ -189,6 +432,65 @@ class Comment(Base):
 
     comments = db.relationship('Comment', lazy='dynamic')
 
+    __table_args__ = (
+        # show_post pages one level of a post's tree by (created_at, id)
+        db.Index('ix_comment_post_id_parent', 'post_id', 'parent_comment_id', 'created_at', 'id'),
+        # Walking down the tree in load_replies
+        db.Index('ix_comment_parent_comment_id', 'parent_comment_id', 'created_at', 'id'),
+        # Archived comments keep their ids, so SQLite mustn't reuse them
+        {'sqlite_autoincrement': True},
+    )
+
+    @staticmethod
+    def version(post_id):
+        """
+        (last change, count) over a post's comments, for conditional GETs
+        """
+        return db.session.query(func.max(Comment.updated_at), func.count(Comment.id)).filter(
+            Comment.post_id == post_id).one()
+
+    @staticmethod
+    def thread(post_id):
+        """
+        Base query for a post's comments, with their authors loaded
+        """
+        return Comment.query.options(joinedload(Comment.author)).filter(
+            Comment.post_id == post_id)
+
+    @staticmethod
+    def load_replies(roots, max_depth):
+        """
+        Fetch every reply under roots, down to max_depth levels, with one
+        recursive query and attach them as comment.replies (oldest first).
+        Comments at the depth limit that have replies of their own get
+        comment.more_replies set so the page can link to the rest.
+        """
+        for comment in roots:
+            comment.replies, comment.more_replies = [], False
+        if not roots or max_depth < 1:
+            return
+
+        tree = db.session.query(Comment.id.label('id'), literal(1).label('depth')).filter(
+            Comment.parent_comment_id.in_([comment.id for comment in roots])).cte(recursive=True)
+        tree = tree.union_all(db.session.query(Comment.id, tree.c.depth + 1).filter(
+            Comment.parent_comment_id == tree.c.id, tree.c.depth < max_depth))
+        rows = Comment.query.options(joinedload(Comment.author)).join(
+            tree, Comment.id == tree.c.id).add_columns(tree.c.depth).order_by(
+            Comment.created_at, Comment.id).all()
+
+        by_id = {comment.id: comment for comment in roots}
+        for comment, depth in rows:
+            comment.replies, comment.more_replies = [], False
+            by_id[comment.id] = comment
+        for comment, depth in rows:
+            by_id[comment.parent_comment_id].replies.append(comment)
+
+        leaves = [comment.id for comment, depth in rows if depth == max_depth]
+        if leaves:
+            for parent_id, in db.session.query(Comment.parent_comment_id).filter(
+                    Comment.parent_comment_id.in_(leaves)).distinct():
+                by_id[parent_id].more_replies = True
+
 
 class Chat(Base):
     id = db.Column(db.Integer, primary_key=True)
@@ -197,6 +499,8 @@ class Chat(Base):
 
     creator_id = db.Column(db.Integer, db.ForeignKey('user.id'))
 
+    follower_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
     posts = db.relationship('Post', backref='chat', lazy='dynamic')
 
     def __repr__(self):
@@ -207,14 +511,391 @@ class Chat(Base):
         return Chat.query.filter(func.lower(Chat.name) == func.lower(name)).first()
 
 
+db.Index('ix_chat_name_lower', func.lower(Chat.name))
+
+
+@task
+def recount():
+    """
+    Rebuild every denormalized counter from the Like and followers tables
+    (archived posts keep the like counts they were archived with)
+    """
+    likes_per_post = db.select([func.count()]).where(
+        Like.post_id == Post.id).as_scalar()
+    db.session.execute(Post.__table__.update().values(like_count=likes_per_post))
+
+    score_per_user = db.select([func.coalesce(func.sum(Post.like_count), 0)]).where(
+        Post.author_id == User.id).as_scalar() + db.select([
+            func.coalesce(func.sum(ArchivedPost.like_count), 0)]).where(
+        ArchivedPost.author_id == User.id).as_scalar()
+    db.session.execute(User.__table__.update().values(score=score_per_user))
+
+    followers_per_chat = db.select([func.count()]).where(
+        followers.c.chat_id == Chat.id).as_scalar()
+    db.session.execute(Chat.__table__.update().values(follower_count=followers_per_chat))
+
+    db.session.commit()
+
+
+# Rankings
+
+HOT_EPOCH = datetime(2020, 1, 1)
+
+
+def hotness(total, created_at):
+    """
+    Time-decayed score: each tenfold increase in total is worth as much as
+    being RANK_HOT_DECAY seconds newer
+    """
+    order = math.log10(max(abs(total), 1))
+    sign = 1 if total > 0 else -1 if total < 0 else 0
+    seconds = (created_at - HOT_EPOCH).total_seconds()
+    return round(sign * order + seconds / current_app.config['RANK_HOT_DECAY'], 7)
+
+
+class Rank(Base):
+    """
+    Precomputed ordering for the ranked pages, one narrow row per ranked item
+    """
+    __abstract__ = True
+    total = db.Column(db.Integer, nullable=False, default=0)
+    hot = db.Column(db.Float, nullable=False, default=0)
+
+    @staticmethod
+    def active_at(item):
+        """
+        The time hot rankings decay from: the item's last activity, which for
+        users and chats is the bump being made now
+        """
+        return datetime.utcnow()
+
+    @classmethod
+    def bump(cls, item, delta):
+        """
+        Add delta to item's total with an atomic `total = total + delta`
+        (inserting its row first if it has none), then recompute its hot score
+        from the new total
+        """
+        active_at = cls.active_at(item)
+        if item.id is None:
+            # Not flushed yet, so no one else can be ranking it
+            db.session.add(cls(item=item, total=delta, hot=hotness(delta, active_at)))
+            return
+        # Core statements don't autoflush; keep them after the session's
+        # pending changes, as a query would
+        db.session.flush()
+        table = cls.__table__
+        row = table.c.id == item.id
+        db.session.execute(insert_ignoring(table), dict(id=item.id))
+        db.session.execute(table.update().where(row).values(total=table.c.total + delta))
+        # The UPDATE holds the row's write lock until commit, so this reads
+        # the total it left
+        total = db.session.execute(db.select([table.c.total]).where(row)).scalar()
+        db.session.execute(table.update().where(row).values(hot=hotness(total, active_at)))
+
+    @classmethod
+    def rebuild(cls, rows, chunk_size=1000):
+        """
+        Replace every rank row from (id, total, active_at) tuples
+        """
+        db.session.query(cls).delete()
+        chunk = []
+        for id, total, active_at in rows:
+            if not total:
+                continue
+            chunk.append(dict(id=id, total=total,
+                              hot=hotness(total, active_at or datetime.utcnow())))
+            if len(chunk) >= chunk_size:
+                db.session.bulk_insert_mappings(cls, chunk)
+                chunk = []
+        db.session.bulk_insert_mappings(cls, chunk)
+        db.session.commit()
+
+    @classmethod
+    def ranked(cls, sort='top'):
+        """
+        Return the base query and keyset pagination keys for a sort order
+        """
+        query = cls.query.filter(cls.total > 0)
+        if sort == 'hot':
+            return query, (cls.hot, cls.id)
+        return query, (cls.total, cls.id)
+
+
+class PostRank(Rank):
+    id = db.Column(db.Integer, db.ForeignKey('post.id'), primary_key=True)
+    item = db.relationship('Post')
+
+    __table_args__ = (
+        db.Index('ix_post_rank_total', 'total', 'id'),
+        db.Index('ix_post_rank_hot', 'hot', 'id'),
+    )
+
+    @staticmethod
+    def active_at(post):
+        # Posts age from when they were made, however recently they were liked
+        return post.created_at or datetime.utcnow()
+
+    @classmethod
+    def ranked(cls, sort='top'):
+        query, keys = super(PostRank, cls).ranked(sort)
+        item = joinedload(PostRank.item)
+        query = query.options(item.joinedload(Post.author),
+                              item.joinedload(Post.chat),
+                              item.joinedload(Post.attachment))
+        return query, keys
+
+
+class ChatRank(Rank):
+    id = db.Column(db.Integer, db.ForeignKey('chat.id'), primary_key=True)
+    item = db.relationship('Chat', lazy='joined')
+
+    __table_args__ = (
+        db.Index('ix_chat_rank_total', 'total', 'id'),
+        db.Index('ix_chat_rank_hot', 'hot', 'id'),
+    )
+
+
+class UserRank(Rank):
+    id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    item = db.relationship('User', lazy='joined')
+
+    __table_args__ = (
+        db.Index('ix_user_rank_total', 'total', 'id'),
+        db.Index('ix_user_rank_hot', 'hot', 'id'),
+    )
+
+
+@task
+def rebuild_ranks():
+    """
+    Rebuild the rank tables in batch from the counter columns. Follows
+    aren't timestamped, so a chat's last activity is its newest post; a
+    user's is the newest like on their posts.
+    """
+    PostRank.rebuild(db.session.query(
+        Post.id, Post.like_count, Post.created_at).yield_per(1000))
+    newest_post = db.select([func.max(Post.created_at)]).where(
+        Post.chat_id == Chat.id).as_scalar()
+    ChatRank.rebuild(db.session.query(
+        Chat.id, Chat.follower_count, func.coalesce(newest_post, Chat.created_at)).yield_per(1000))
+    newest_like = db.select([func.max(Like.created_at)]).where(
+        (Like.post_id == Post.id) & (Post.author_id == User.id)).as_scalar()
+    UserRank.rebuild(db.session.query(
+        User.id, User.score, func.coalesce(newest_like, User.created_at)).yield_per(1000))
+
 
 # Images
 
 class Image(Base):
     id = db.Column(db.Integer, primary_key=True)
 
-    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=True, index=True)
+    # Set instead of post_id once the post is moved to the archive
+    archived_post_id = db.Column(db.Integer, index=True)
 
     filename = db.Column(db.String(300))
     url = db.Column(db.String(300))
 
+    # sha256 of the original upload, which is stored under that name
+    digest = db.Column(db.String(64), index=True)
+    width = db.Column(db.Integer)
+    height = db.Column(db.Integer)
+    # JSON {label: {name, width, height}}, filled in once processing finishes
+    renditions = db.Column(db.Text)
+
+    def fit(self, width, height):
+        """
+        URL of the smallest rendition that fills a width x height box, or of
+        the largest if none does. None until processing has made them: the
+        original upload is never served.
+        """
+        return fit_rendition(self.renditions, width, height)
+
+
+def fit_rendition(renditions, width, height):
+    """
+    Image.fit for an Image.renditions value
+    """
+    if not renditions:
+        return None
+    renditions = sorted(json.loads(renditions).values(), key=lambda r: r['width'])
+    for rendition in renditions:
+        if rendition['width'] >= width or rendition['height'] >= height:
+            return images.url(rendition['name'])
+    return images.url(renditions[-1]['name'])
+
+
+# Archive
+#
+# Posts older than ARCHIVE_AFTER_DAYS are moved, with their comments and
+# likes, into these tables by archive_posts(), keeping the hot tables and
+# their indexes small. They live in the same database, so a batch moves in
+# one transaction. Rows keep their ids, so links to archived posts still
+# resolve.
+
+
+class ArchivedPost(Base):
+    __tablename__ = 'post_archive'
+    # Read-only, and rendered with the post templates
+    archived = True
+    template_name = 'post'
+
+    id = db.Column(db.Integer, primary_key=True)
+    title = db.Column(db.String(128))
+    body = db.Column(db.String(2048))
+    author_id = db.Column(db.Integer)
+    chat_id = db.Column(db.Integer)
+    like_count = db.Column(db.Integer, nullable=False, default=0)
+
+    author = db.relationship('User', primaryjoin='foreign(ArchivedPost.author_id) == User.id')
+    chat = db.relationship('Chat', primaryjoin='foreign(ArchivedPost.chat_id) == Chat.id')
+    attachment = db.relationship('Image', uselist=False,
+                                 primaryjoin='ArchivedPost.id == foreign(Image.archived_post_id)')
+
+    __table_args__ = (
+        db.Index('ix_post_archive_author_id_created_at', 'author_id', 'created_at', 'id'),
+    )
+
+    body_e = Post.body_e
+
+    @staticmethod
+    def versions(*criterion):
+        return db.session.query(ArchivedPost.id, ArchivedPost.updated_at, ArchivedPost.like_count,
+                                Image.updated_at.label('attachment_updated_at')).outerjoin(
+            ArchivedPost.attachment).filter(*criterion)
+
+    @staticmethod
+    def feed():
+        return ArchivedPost.query.options(
+            joinedload(ArchivedPost.author),
+            joinedload(ArchivedPost.chat),
+            joinedload(ArchivedPost.attachment))
+
+
+class ArchivedComment(Base):
+    __tablename__ = 'comment_archive'
+    template_name = 'comment'
+
+    id = db.Column(db.Integer, primary_key=True)
+    body = db.Column(db.String(512))
+    author_id = db.Column(db.Integer)
+    post_id = db.Column(db.Integer)
+    parent_comment_id = db.Column(db.Integer)
+
+    author = db.relationship('User', primaryjoin='foreign(ArchivedComment.author_id) == User.id')
+
+    __table_args__ = (
+        db.Index('ix_comment_archive_post_id_parent', 'post_id', 'parent_comment_id',
+                 'created_at', 'id'),
+    )
+
+    @staticmethod
+    def thread(post_id):
+        return ArchivedComment.query.options(joinedload(ArchivedComment.author)).filter(
+            ArchivedComment.post_id == post_id)
+
+    @staticmethod
+    def load_replies(comments):
+        """
+        Archived pages show one level at a time: mark which comments have
+        replies so they get a "More replies" link
+        """
+        ids = [comment.id for comment in comments]
+        parents = {parent for parent, in db.session.query(ArchivedComment.parent_comment_id).filter(
+            ArchivedComment.parent_comment_id.in_(ids)).distinct()} if ids else set()
+        for comment in comments:
+            comment.replies = []
+            comment.more_replies = comment.id in parents
+
+
+class ArchivedLike(Base):
+    __tablename__ = 'like_archive'
+
+    user_id = db.Column(db.Integer, primary_key=True)
+    post_id = db.Column(db.Integer, primary_key=True)
+    liked = db.Column(db.Boolean)
+
+
+def copy_rows(source, target, where):
+    columns = [column.name for column in target.__table__.columns]
+    rows = db.select([source.__table__.c[name] for name in columns]).where(where)
+    db.session.execute(target.__table__.insert().from_select(columns, rows))
+
+
+@task
+def archive_posts(batch_size=None, before=None):
+    """
+    Move one batch of the oldest posts created before `before` (default:
+    ARCHIVE_AFTER_DAYS ago), with their comments and likes, into the archive
+    tables. Returns how many posts were moved; 0 means nothing is left.
+    """
+    from app import search
+    batch_size = batch_size or current_app.config['ARCHIVE_BATCH_SIZE']
+    before = before or datetime.utcnow() - timedelta(days=current_app.config['ARCHIVE_AFTER_DAYS'])
+    ids = [id for id, in db.session.query(Post.id).filter(Post.created_at < before).order_by(
+        Post.created_at, Post.id).limit(batch_size)]
+    if not ids:
+        return 0
+
+    copy_rows(Post, ArchivedPost, Post.id.in_(ids))
+    copy_rows(Comment, ArchivedComment, Comment.post_id.in_(ids))
+    copy_rows(Like, ArchivedLike, Like.post_id.in_(ids))
+    # Attachments stay put, re-pointed at the archived post before the
+    # foreign key to post would be broken
+    Image.query.filter(Image.post_id.in_(ids)).update(
+        {Image.archived_post_id: Image.post_id, Image.post_id: None}, synchronize_session=False)
+
+    for model, column in ((Like, Like.post_id), (Comment, Comment.post_id),
+                          (Timeline, Timeline.post_id), (PostRank, PostRank.id)):
+        model.query.filter(column.in_(ids)).delete(synchronize_session=False)
+    connection = db.session.connection()
+    for id in ids:
+        search.sync(connection, Post, id, delete=True)
+    Post.query.filter(Post.id.in_(ids)).delete(synchronize_session=False)
+    db.session.commit()
+    return len(ids)
+
+
+# Jobs
+
+class Job(Base):
+    """
+    A queued call to a function registered with app.util.jobs.task
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64), nullable=False)
+    payload = db.Column(db.Text, nullable=False, default='{}')
+    # Jobs with the same name and key aren't queued twice while one is pending
+    key = db.Column(db.String(255))
+
+    state = db.Column(db.String(16), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    error = db.Column(db.Text)
+
+    __table_args__ = (
+        db.Index('ix_job_state_run_at', 'state', 'run_at'),
+        db.Index('ix_job_name_key_pending', 'name', 'key', unique=True,
+                 postgresql_where=db.text("state IN ('queued', 'running')"),
+                 sqlite_where=db.text("state IN ('queued', 'running')")),
+    )
+
+    def __repr__(self):
+        return '<Job {} {} {}>'.format(self.id, self.name, self.state)
+
+
+class Event(db.Model):
+    """
+    A live update published with app.util.events.publish, kept for
+    EVENTS_RETENTION seconds so reconnecting clients can catch up
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    channel = db.Column(db.String(64), nullable=False)
+    data = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    __table_args__ = (
+        db.Index('ix_event_channel_id', 'channel', 'id'),
+    )
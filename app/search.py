@@ -0,0 +1,222 @@
+"""
+Full-text search over posts, chats and users.
+
+Each searchable model gets a companion index table: an FTS5 virtual table on
+SQLite, or a tsvector table with a GIN index on Postgres. Mapper events keep
+it in sync with the model, and search() returns ids ranked by relevance along
+with highlighted fields.
+"""
+import re
+from flask import request
+from sqlalchemy import Float, Integer, column, event, inspect, text
+
+from app import db
+from app.models import Post, Chat, User
+from app.util.pagination import decode_cursor, encode_cursor, page_links
+
+
+# Private-use characters that mark matches until the highlight filter turns
+# them into <mark> tags after escaping
+MARK_START = '\ue000'
+MARK_END = '\ue001'
+
+INDEXED = {
+    Post: ('title', 'body'),
+    Chat: ('name', 'about'),
+    User: ('username',),
+}
+
+
+def is_index_table(name):
+    """
+    Whether a table name is one of the index tables, or on SQLite one of the
+    shadow tables FTS5 keeps for it. They're made here rather than by
+    migrations, so autogenerate must leave them alone.
+    """
+    return any(name == model.__tablename__ + '_search' or
+               name.startswith(model.__tablename__ + '_search_') for model in INDEXED)
+
+
+def index_name(model, dialect):
+    return dialect.identifier_preparer.quote(model.__tablename__ + '_search')
+
+
+def table_name(model, dialect):
+    return dialect.identifier_preparer.quote(model.__tablename__)
+
+
+def document(model, dialect):
+    fields = ' || \' \' || '.join(
+        'coalesce({}, \'\')'.format(dialect.identifier_preparer.quote(field))
+        for field in INDEXED[model])
+    return 'to_tsvector(\'simple\', {})'.format(fields)
+
+
+# Index tables
+
+def create_statements(dialect):
+    for model, fields in INDEXED.items():
+        index = index_name(model, dialect)
+        if dialect.name == 'sqlite':
+            yield 'CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5({})'.format(
+                index, ', '.join(fields))
+        elif dialect.name == 'postgresql':
+            yield 'CREATE TABLE IF NOT EXISTS {} (id INTEGER PRIMARY KEY, document TSVECTOR)'.format(index)
+            yield 'CREATE INDEX IF NOT EXISTS {} ON {} USING gin (document)'.format(
+                dialect.identifier_preparer.quote('ix_' + model.__tablename__ + '_search'), index)
+
+
+def rebuild():
+    """
+    Recreate every index table from its model table
+    """
+    connection = db.session.connection()
+    dialect = connection.dialect
+    for statement in create_statements(dialect):
+        connection.execute(statement)
+    for model, fields in INDEXED.items():
+        index, table = index_name(model, dialect), table_name(model, dialect)
+        connection.execute('DELETE FROM {}'.format(index))
+        if dialect.name == 'sqlite':
+            connection.execute('INSERT INTO {} (rowid, {}) SELECT id, {} FROM {}'.format(
+                index, ', '.join(fields), ', '.join(fields), table))
+        elif dialect.name == 'postgresql':
+            connection.execute('INSERT INTO {} (id, document) SELECT id, {} FROM {}'.format(
+                index, document(model, dialect), table))
+    db.session.commit()
+
+
+def sync(connection, model, id, delete=False):
+    dialect = connection.dialect
+    index, fields = index_name(model, dialect), INDEXED[model]
+    if dialect.name == 'sqlite':
+        connection.execute(text('DELETE FROM {} WHERE rowid = :id'.format(index)), id=id)
+        if not delete:
+            connection.execute(text('INSERT INTO {} (rowid, {}) SELECT id, {} FROM {} WHERE id = :id'.format(
+                index, ', '.join(fields), ', '.join(fields), table_name(model, dialect))), id=id)
+    elif dialect.name == 'postgresql':
+        connection.execute(text('DELETE FROM {} WHERE id = :id'.format(index)), id=id)
+        if not delete:
+            connection.execute(text('INSERT INTO {} (id, document) SELECT id, {} FROM {} WHERE id = :id'.format(
+                index, document(model, dialect), table_name(model, dialect))), id=id)
+
+
+def init_app(app):
+    with app.app_context():
+        engine = db.engine
+
+    @event.listens_for(engine, 'first_connect')
+    def on_first_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for statement in create_statements(engine.dialect):
+            cursor.execute(statement)
+        cursor.close()
+        dbapi_connection.commit()
+
+
+def listen(model):
+    @event.listens_for(model, 'after_insert')
+    def after_insert(mapper, connection, target):
+        sync(connection, model, target.id)
+
+    @event.listens_for(model, 'after_update')
+    def after_update(mapper, connection, target):
+        # Skip the frequent counter and last_seen writes
+        state = inspect(target)
+        if any(state.attrs[field].history.has_changes() for field in INDEXED[model]):
+            sync(connection, model, target.id)
+
+    @event.listens_for(model, 'after_delete')
+    def after_delete(mapper, connection, target):
+        sync(connection, model, target.id, delete=True)
+
+
+for model in INDEXED:
+    listen(model)
+
+
+# Querying
+
+def search(model, terms, limit, after=None, before=None):
+    """
+    Return [(id, score, {field: highlighted text})] for rows matching every
+    word in terms as a prefix, most relevant first. after or before is the
+    (score, id) of a row to continue from, for keyset paging.
+    """
+    words = re.findall(r'\w+', terms)
+    if not words:
+        return []
+    connection = db.session.connection()
+    dialect = connection.dialect
+    index, fields = index_name(model, dialect), INDEXED[model]
+
+    cursor = after or before
+    where = '(score, id) {} (:score, :id)'.format('>' if before else '<') if cursor else '1 = 1'
+    order = 'ASC' if before else 'DESC'
+    score, id = cursor or (None, None)
+
+    if dialect.name == 'sqlite':
+        query = ' '.join('"{}"*'.format(word) for word in words)
+        marks = ', '.join(
+            "snippet({index}, {i}, :start, :end, '...', 32) AS field{i}".format(index=index, i=i)
+            for i in range(len(fields)))
+        # bm25() is lower for better matches; negated so higher is better on
+        # both databases
+        rows = connection.execute(text(
+            'SELECT id, score, {} FROM ('
+            ' SELECT rowid AS id, -bm25({index}) AS score, {marks} FROM {index}'
+            ' WHERE {index} MATCH :query'
+            ') WHERE {where} ORDER BY score {order}, id {order} LIMIT :limit'.format(
+                ', '.join('field{}'.format(i) for i in range(len(fields))),
+                index=index, marks=marks, where=where, order=order)),
+            query=query, start=MARK_START, end=MARK_END, limit=limit, score=score, id=id)
+    elif dialect.name == 'postgresql':
+        query = ' & '.join('{}:*'.format(word) for word in words)
+        options = 'StartSel={}, StopSel={}'.format(MARK_START, MARK_END)
+        marks = ', '.join(
+            "ts_headline('simple', coalesce(t.{field}, ''), q, :options)".format(
+                field=dialect.identifier_preparer.quote(field))
+            for field in fields)
+        rows = connection.execute(text(
+            'SELECT t.id, hits.score, {marks} FROM ('
+            ' SELECT * FROM ('
+            '  SELECT id, ts_rank(document, q)::float8 AS score'
+            '  FROM {index}, to_tsquery(\'simple\', :query) q WHERE document @@ q'
+            ' ) matches WHERE {where} ORDER BY score {order}, id {order} LIMIT :limit'
+            ') hits JOIN {table} t ON t.id = hits.id, to_tsquery(\'simple\', :query) q '
+            'ORDER BY hits.score {order}, hits.id {order}'.format(
+                marks=marks, index=index, table=table_name(model, dialect),
+                where=where, order=order)),
+            query=query, options=options, limit=limit, score=score, id=id)
+    else:
+        return []
+
+    return [(row[0], row[1], dict(zip(fields, row[2:]))) for row in rows]
+
+
+def lookup(query, model, terms, per_page):
+    """
+    Run a search and load one page of the matching rows through query (for
+    eager loading), in relevance order. Pages are addressed with the same
+    ?after=/?before= cursors as paginate(), over (score, id), and the page
+    links carry the terms as ?q=. Returns (rows, {id: highlights}, next_url,
+    prev_url).
+    """
+    keys = (column('score', Float), column('id', Integer))
+    after = request.args.get('after')
+    before = request.args.get('before')
+    hits = search(model, terms, per_page + 1,
+                  after=after and decode_cursor(after, keys),
+                  before=before and decode_cursor(before, keys))
+    has_more = len(hits) > per_page
+    hits = hits[:per_page]
+    if before:
+        hits.reverse()
+    next_url, prev_url = page_links(hits, has_more, lambda hit: encode_cursor([hit[1], hit[0]]),
+                                   q=terms)
+
+    if not hits:
+        return [], {}, next_url, prev_url
+    rows = {row.id: row for row in query.filter(model.id.in_([id for id, _, _ in hits]))}
+    return [rows[id] for id, _, _ in hits if id in rows], \
+        {id: marks for id, _, marks in hits}, next_url, prev_url
@@ -0,0 +1,69 @@
+// Applies live updates from /events to the current page, polling every few
+// seconds. The page lists its channels in the data-channels attribute of
+// this script's tag.
+(function () {
+  var script = document.currentScript;
+  var channels = JSON.parse(script.getAttribute('data-channels'));
+  if (!window.fetch || !channels.length) {
+    return;
+  }
+  var query = channels.map(function (c) { return 'channel=' + encodeURIComponent(c); }).join('&');
+  var url = script.getAttribute('data-events') + '?' + query;
+  var interval = 5, cursor = null, seen = {};
+
+  function notice(id, text) {
+    var box = document.getElementById(id);
+    if (box) {
+      box.style.display = 'block';
+      box.querySelector('.live-text').textContent = text;
+    }
+  }
+
+  var newPosts = 0, newComments = 0;
+  function apply(event) {
+    if (event.type === 'likes') {
+      document.querySelectorAll('.like-count[data-post="' + event.id + '"]').forEach(function (el) {
+        el.textContent = event.count;
+      });
+    } else if (event.type === 'post') {
+      newPosts += 1;
+      notice('live-posts', newPosts + ' new post' + (newPosts > 1 ? 's' : '') +
+             ', latest "' + event.title + '" by ' + event.author);
+    } else if (event.type === 'comment') {
+      newComments += 1;
+      notice('live-comments', newComments + ' new comment' + (newComments > 1 ? 's' : '') +
+             ', latest by ' + event.author + ': ' + event.body);
+    }
+  }
+
+  function poll() {
+    fetch(url + (cursor === null ? '' : '&since=' + cursor), {credentials: 'same-origin'})
+      .then(function (response) {
+        if (!response.ok) {
+          throw new Error(response.status);
+        }
+        return response.json();
+      })
+      .then(function (body) {
+        // Each poll re-reads a window of recent events, so skip repeats
+        var current = {};
+        body.events.forEach(function (event) {
+          current[event.event] = true;
+          if (!seen[event.event]) {
+            apply(event);
+          }
+        });
+        seen = current;
+        cursor = body.cursor;
+        interval = body.interval;
+      })
+      .catch(function () {
+        // Back off while the server is unreachable or erroring
+        interval = Math.min(interval * 2, 60);
+      })
+      .then(function () {
+        setTimeout(poll, interval * 1000);
+      });
+  }
+  poll();
+})();
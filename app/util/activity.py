@@ -0,0 +1,66 @@
+from datetime import datetime
+from threading import Event, Lock, Thread
+import atexit
+
+from sqlalchemy import bindparam
+
+
+class ActivityTracker(object):
+    """
+    Collects last-seen times in memory and writes them out in batches from a
+    background thread, so page views don't each commit a write. A user's row
+    is updated at most once per LAST_SEEN_INTERVAL seconds.
+    """
+
+    def __init__(self, app=None, db=None):
+        self.pending = {}
+        self.lock = Lock()
+        self.stopped = Event()
+        self.thread = None
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        self.app = app
+        self.db = db
+        self.interval = app.config['LAST_SEEN_INTERVAL']
+        self.batch_size = app.config['LAST_SEEN_BATCH_SIZE']
+        atexit.register(self.stop)
+
+    def touch(self, user_id, when=None):
+        with self.lock:
+            self.pending[user_id] = when or datetime.utcnow()
+            if self.thread is None:
+                self.thread = Thread(target=self.run, name='last-seen-flusher', daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('Failed to flush last_seen times')
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+
+        from app.models import User
+        table = User.__table__
+        # Leave updated_at alone: a visit isn't a change to the profile
+        update = table.update().where(table.c.id == bindparam('user_id')).values(
+            last_seen=bindparam('seen'), updated_at=table.c.updated_at)
+        rows = [dict(user_id=user_id, seen=seen) for user_id, seen in pending.items()]
+        with self.app.app_context():
+            with self.db.engine.begin() as connection:
+                for i in range(0, len(rows), self.batch_size):
+                    connection.execute(update, rows[i:i + self.batch_size])
+
+    def stop(self):
+        """
+        Stop the flusher and write out whatever is still pending
+        """
+        self.stopped.set()
+        self.flush()
@@ -0,0 +1,90 @@
+from collections import OrderedDict
+from threading import Lock
+import os
+import struct
+import zlib
+
+from app.util.files import write_atomically
+
+
+def identicon(digest, size):
+    """
+    Draw a GitHub-style 5x5 mirrored identicon for a hex digest as PNG bytes.
+    The same digest always gives the same image.
+    """
+    nibbles = [int(c, 16) for c in digest]
+    color = tuple(int(digest[i:i + 2], 16) // 2 + 64 for i in (0, 2, 4))
+    background = (240, 240, 240)
+    cells = [[False] * 5 for _ in range(5)]
+    for i in range(15):
+        row, col = i % 5, i // 5
+        cells[row][col] = cells[row][4 - col] = nibbles[i + 6] % 2 == 0
+
+    pad = size // 12
+    inner = max(size - 2 * pad, 1)
+    rows = []
+    for y in range(size):
+        row = bytearray(b'\x00')  # no PNG filter
+        for x in range(size):
+            cx, cy = (x - pad) * 5 // inner, (y - pad) * 5 // inner
+            on = 0 <= cx < 5 and 0 <= cy < 5 and cells[cy][cx]
+            row.extend(color if on else background)
+        rows.append(bytes(row))
+
+    def chunk(kind, data):
+        body = kind + data
+        return struct.pack('>I', len(data)) + body + struct.pack('>I', zlib.crc32(body))
+
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        chunk(b'IHDR', struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0)),
+        chunk(b'IDAT', zlib.compress(b''.join(rows), 9)),
+        chunk(b'IEND', b''),
+    ])
+
+
+class AvatarStore(object):
+    """
+    Generated avatars, kept on disk so every process shares them and in an
+    in-process LRU for the hot ones
+    """
+
+    def __init__(self, app=None):
+        self.cache = OrderedDict()
+        self.lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.path = app.config['AVATAR_DIR']
+        self.cache_size = app.config['AVATAR_CACHE_SIZE']
+
+    def get(self, digest, size, known=None):
+        """
+        PNG bytes for digest at size. known, if given, is called with a digest
+        that has nothing stored yet; when it returns False the identicon is
+        drawn but not written to disk, so made-up digests can't fill it.
+        """
+        key = (digest, size)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+
+        filename = os.path.join(self.path, digest[:2], '{}-{}.png'.format(digest, size))
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = identicon(digest, size)
+            if known is not None and not known(digest):
+                return self.remember(key, data)
+            write_atomically(filename, data)
+        return self.remember(key, data)
+
+    def remember(self, key, data):
+        with self.lock:
+            self.cache[key] = data
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return data
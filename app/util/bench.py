@@ -0,0 +1,106 @@
+"""
+Drive the main pages through the Flask test client and report latency and
+query counts per route, so runs on different commits can be diffed. Also
+times a cold `import app` per module.
+"""
+from statistics import mean
+from time import perf_counter
+import subprocess
+import sys
+
+from sqlalchemy import event, func
+from sqlalchemy.engine import Engine
+
+from flask import current_app
+
+from app import db, basedir
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def targets():
+    """
+    A representative URL for each benchmarked view, picked from the data
+    """
+    from app.models import User, Chat, Post, Comment
+    chat = Chat.query.order_by(Chat.follower_count.desc()).first()
+    user = User.query.order_by(User.score.desc()).first()
+    post_id = db.session.query(Comment.post_id).group_by(Comment.post_id).order_by(
+        func.count().desc()).limit(1).scalar() or Post.query.first().id
+    viewer = db.session.query(User.id).filter(User.id != user.id).order_by(User.id).limit(1).scalar()
+    return viewer or user.id, [
+        ('index', '/index'),
+        ('popular', '/popular'),
+        ('leaderboard', '/leaderboard'),
+        ('explore_chats', '/explore_chats'),
+        ('show_chat', '/chat/{}'.format(chat.name)),
+        ('show_post', '/post/{}'.format(post_id)),
+        ('show_user', '/user/{}'.format(user.username)),
+    ]
+
+
+def run(repeat=20, warmup=2):
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    viewer_id, urls = targets()
+    client = current_app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(viewer_id)
+        session['_fresh'] = True
+
+    # Every engine, so queries sent to read replicas are counted too
+    event.listen(Engine, 'before_cursor_execute', count)
+    results = {}
+    try:
+        for name, url in urls:
+            timings, queries = [], []
+            for i in range(warmup + repeat):
+                del statements[:]
+                start = perf_counter()
+                response = client.get(url)
+                elapsed = (perf_counter() - start) * 1000
+                if response.status_code != 200:
+                    raise RuntimeError('{} returned {}'.format(url, response.status_code))
+                if i >= warmup:
+                    timings.append(elapsed)
+                    queries.append(len(statements))
+            results[name] = dict(url=url, requests=repeat,
+                                 p50_ms=round(percentile(timings, 50), 2),
+                                 p95_ms=round(percentile(timings, 95), 2),
+                                 mean_ms=round(mean(timings), 2),
+                                 queries=max(queries))
+    finally:
+        event.remove(Engine, 'before_cursor_execute', count)
+    return results
+
+
+def startup(repeat=5, top=25):
+    """
+    Build the app (import run.py) in fresh interpreters with -X importtime
+    and report the best of `repeat` runs for the total and for the `top`
+    slowest modules (cumulative time, including the modules each one imports)
+    """
+    best = {}
+    for i in range(repeat):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import run'],
+                                cwd=basedir, stderr=subprocess.PIPE, universal_newlines=True,
+                                check=True)
+        for line in result.stderr.splitlines():
+            if not line.startswith('import time:') or 'self [us]' in line:
+                continue
+            own, cumulative, name = line[len('import time:'):].split('|')
+            module = name.strip()
+            own, cumulative = int(own) / 1000, int(cumulative) / 1000
+            if module not in best or cumulative < best[module][1]:
+                best[module] = (own, cumulative)
+
+    slowest = sorted(best.items(), key=lambda item: -item[1][1])
+    return dict(total_ms=round(best['run'][1], 1), modules=[
+        dict(module=module, self_ms=round(own, 1), cumulative_ms=round(cumulative, 1))
+        for module, (own, cumulative) in slowest[:top]])
@@ -0,0 +1,45 @@
+from functools import lru_cache
+from markupsafe import Markup
+import re
+
+
+class Censor(object):
+    """
+    Masks every listed word in a single regex pass. The words are compiled
+    once into one alternation (longest first), and results are memoized per
+    input string since the same titles and bodies are rendered over and over.
+    """
+
+    def __init__(self, words, cache_size=4096):
+        words = sorted({word.strip().lower() for word in words if word.strip()},
+                       key=len, reverse=True)
+        self.pattern = re.compile('|'.join(map(re.escape, words)), re.IGNORECASE) if words else None
+        self._censor = lru_cache(maxsize=cache_size)(self._censor)
+
+    @staticmethod
+    def _mask(match):
+        word = match.group()
+        i = min(1, len(word) - 1)
+        return word[:i] + '*' + word[i+1:]
+
+    def _censor(self, text):
+        return self.pattern.sub(self._mask, text)
+
+    def __call__(self, text):
+        if self.pattern is None or not text:
+            return text
+        result = self._censor(str(text))
+        return Markup(result) if isinstance(text, Markup) else result
+
+
+def load_words(config):
+    """
+    Read the word list from CENSOR_WORDS plus one word per line of
+    CENSOR_WORDS_FILE, if set
+    """
+    words = list(config.get('CENSOR_WORDS', ()))
+    path = config.get('CENSOR_WORDS_FILE')
+    if path:
+        with open(path, encoding='utf-8') as f:
+            words.extend(line for line in f if not line.startswith('#'))
+    return words
@@ -0,0 +1,62 @@
+"""
+Conditional GETs for pages rendered from database rows.
+
+A view computes a validator from cheap queries (the parent row's updated_at
+and counters, the ids, updated_at and counters of just the rows on the page,
+and the viewer's likes and follows among them), asks not_modified() before
+loading and rendering anything else, and stamps the final response with
+apply().
+
+Counters such as like_count change without moving updated_at, so pages that
+show them are validated by ETag alone; Last-Modified is only sent for pages
+whose every change moves a timestamp.
+"""
+from hashlib import md5
+from time import time
+import json
+
+from flask import current_app, make_response, request, session
+from flask_login import current_user
+
+
+class Conditional(object):
+    """
+    ETag, and Last-Modified if given, for one page. The ETag covers the data
+    versions given plus everything else that changes the HTML for the same
+    rows: the URL (cursors, thread), the viewer, and the CSRF token window.
+    """
+
+    def __init__(self, *versions, last_modified=None):
+        self.last_modified = last_modified.replace(microsecond=0) if last_modified else None
+        window = current_app.config.get('WTF_CSRF_TIME_LIMIT') or 3600
+        key = [request.full_path, current_user.get_id(), int(time() // (window / 2)),
+               last_modified.isoformat() if last_modified else None] + list(versions)
+        self.etag = md5(json.dumps(key, default=str).encode('utf-8')).hexdigest()
+
+    def not_modified(self):
+        """
+        Return a 304 response if the client's copy is current, otherwise None
+        """
+        if session.get('_flashes'):
+            # The page would show a message the cached copy doesn't have
+            return None
+        if request.if_none_match:
+            fresh = request.if_none_match.contains(self.etag)
+        elif request.if_modified_since and self.last_modified:
+            fresh = self.last_modified <= request.if_modified_since
+        else:
+            fresh = False
+        if fresh:
+            return self.apply(make_response('', 304))
+
+    def apply(self, response):
+        response = make_response(response)
+        response.set_etag(self.etag)
+        if self.last_modified:
+            response.last_modified = self.last_modified
+        # Pages differ per viewer, so only the browser may cache them, and it
+        # must revalidate every time
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        response.vary.add('Cookie')
+        return response
@@ -0,0 +1,92 @@
+from threading import Lock
+from time import monotonic
+import os
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class PasswordHasher(object):
+    """
+    Hashes passwords with the PASSWORD_HASH_METHOD and PASSWORD_SALT_LENGTH
+    settings, and tells when a stored hash was made with other parameters so
+    it can be upgraded at the next successful login.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.method = app.config['PASSWORD_HASH_METHOD']
+        self.salt_length = app.config['PASSWORD_SALT_LENGTH']
+        self._dummy = None
+
+    @property
+    def dummy(self):
+        """
+        Hash verified against for unknown users, so a miss costs the same as
+        a wrong password. Made on first use rather than at import, since it
+        takes as long as a login.
+        """
+        if self._dummy is None:
+            self._dummy = self.hash(os.urandom(16).hex())
+        return self._dummy
+
+    @property
+    def prefix(self):
+        # The canonical form of the method (werkzeug fills in the default
+        # iteration count)
+        return self.dummy.split('$', 1)[0]
+
+    def hash(self, password):
+        return generate_password_hash(password, method=self.method, salt_length=self.salt_length)
+
+    def verify(self, pwhash, password):
+        if not pwhash:
+            check_password_hash(self.dummy, password)
+            return False
+        return check_password_hash(pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        method, salt = pwhash.split('$', 2)[:2]
+        return method != self.prefix or len(salt) != self.salt_length
+
+
+class RateLimiter(object):
+    """
+    Token buckets keyed by arbitrary strings (IP address, IP and username). Each
+    bucket holds up to `capacity` tokens and refills completely over `period`
+    seconds; allow() takes a token, or returns False if the bucket is empty.
+    """
+
+    def __init__(self, capacity=None, period=None, max_keys=10000):
+        self.max_keys = max_keys
+        self.buckets = {}
+        self.lock = Lock()
+        if capacity is not None:
+            self.configure(capacity, period)
+
+    def configure(self, capacity, period):
+        self.capacity = capacity
+        self.rate = capacity / period
+
+    def allow(self, key):
+        now = monotonic()
+        with self.lock:
+            tokens, last = self.buckets.get(key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - last) * self.rate)
+            allowed = tokens >= 1
+            self.buckets[key] = (tokens - 1 if allowed else tokens, now)
+            if len(self.buckets) > self.max_keys:
+                self.prune(now)
+            return allowed
+
+    def reset(self, key):
+        with self.lock:
+            self.buckets.pop(key, None)
+
+    def prune(self, now):
+        # Drop buckets that would be full again; they behave like new ones
+        full = self.capacity / self.rate
+        self.buckets = {key: (tokens, last) for key, (tokens, last) in self.buckets.items()
+                        if now - last < full}
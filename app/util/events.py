@@ -0,0 +1,75 @@
+"""
+Live updates, fetched by browsers with short polling.
+
+publish() adds an Event row to the current transaction, so an update goes out
+only if the change it describes is committed. Pages poll /events every
+EVENTS_POLL_INTERVAL seconds with the cursor from their last poll; a poll is
+an ordinary short request, so no server thread is held between them.
+
+Event ids and created_at are assigned at insert, before commit, so a row can
+become visible after rows that follow it. Each poll therefore re-reads the
+last EVENTS_WINDOW seconds before its cursor, and the page drops events it
+has already seen.
+"""
+from calendar import timegm
+from datetime import datetime, timedelta
+import json
+import re
+
+from flask import current_app
+
+from app import db
+from app.util.jobs import task, enqueue
+
+
+CHANNEL = re.compile(r'^(chat|post):\d+$')
+
+
+def publish(channel, type, **data):
+    """
+    Queue an event on channel, to be sent when the session commits. Nothing
+    is stored unless LIVE_UPDATES is on, since no page would poll for it.
+    """
+    from app.models import Event
+    if not current_app.config['LIVE_UPDATES']:
+        return
+    db.session.add(Event(channel=channel, data=json.dumps(dict(data, type=type))))
+    enqueue('prune_events', key='prune_events', delay=current_app.config['EVENTS_RETENTION'])
+
+
+def timestamp(when):
+    return timegm(when.utctimetuple()) + when.microsecond / 1e6
+
+
+def recent(channels, since=None):
+    """
+    Return (events, cursor): the events on channels from EVENTS_WINDOW
+    seconds before the cursor since (None on a page's first poll), oldest
+    first, and the cursor for the next poll. Raises ValueError if since
+    isn't a representable time.
+    """
+    from app.models import Event
+    now = datetime.utcnow()
+    if since is None:
+        return [], timestamp(now)
+    try:
+        start = datetime.utcfromtimestamp(since) - \
+            timedelta(seconds=current_app.config['EVENTS_WINDOW'])
+    except (OverflowError, OSError, ValueError):
+        raise ValueError('Invalid cursor {!r}'.format(since))
+    # The newest EVENTS_MAX_BATCH, should a page fall far behind
+    rows = db.session.query(Event.id, Event.data).filter(
+        Event.channel.in_(channels), Event.created_at > start).order_by(Event.id.desc()).limit(
+        current_app.config['EVENTS_MAX_BATCH']).all()
+    return [dict(json.loads(data), event=id) for id, data in reversed(rows)], timestamp(now)
+
+
+@task
+def prune_events():
+    """
+    Delete events older than EVENTS_RETENTION seconds
+    """
+    from app.models import Event
+    before = datetime.utcnow() - timedelta(seconds=current_app.config['EVENTS_RETENTION'])
+    Event.query.filter(Event.created_at < before).delete(synchronize_session=False)
+    db.session.commit()
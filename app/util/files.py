@@ -0,0 +1,24 @@
+import os
+import tempfile
+
+
+def write_atomically(path, data):
+    """
+    Write bytes or text to path, replacing any file there in one step so
+    readers in other threads and processes never see a partial file
+    """
+    directory = os.path.dirname(path) or os.curdir
+    os.makedirs(directory, exist_ok=True)
+    # A unique temporary name in the same directory: several writers may be
+    # at work at once, and os.replace can't cross filesystems
+    mode = 'w' if isinstance(data, str) else 'wb'
+    encoding = 'utf-8' if isinstance(data, str) else None
+    f = tempfile.NamedTemporaryFile(mode, encoding=encoding, dir=directory,
+                                    suffix='.tmp', delete=False)
+    try:
+        with f:
+            f.write(data)
+        os.replace(f.name, path)
+    except BaseException:
+        os.remove(f.name)
+        raise
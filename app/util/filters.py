@@ -1,5 +1,6 @@
-from flask import escape
-from app import app
+from flask import current_app, escape
+from markupsafe import Markup
+from app.util.censor import Censor, load_words
 import re
 
 
@@ -8,18 +9,28 @@ def nl2br(text):
     return text.replace('\n', '<br>')
 
 
-@app.template_filter()
 def censor(text):
-    bad_words = {
-        'dick': 1,
-        'fuck': 1,
-        'cock': 1
-    }
-    for bad_word, i in bad_words.items():
-        for m in re.finditer(bad_word, text, re.IGNORECASE):
-            ch_idx = m.start()+i
-            text = text[:ch_idx] + '*' + text[ch_idx+1:]
-    return text
+    masker = current_app.extensions.get('censor')
+    if masker is None:
+        masker = current_app.extensions['censor'] = Censor(
+            load_words(current_app.config), current_app.config['CENSOR_CACHE_SIZE'])
+    return masker(text)
+
+
+def highlight(text):
+    """
+    Escape a search snippet and wrap its marked matches in <mark> tags
+    """
+    from app.search import MARK_START, MARK_END
+    text = str(escape(text))
+    text = re.sub('{}([^{}]*){}?'.format(MARK_START, MARK_END, MARK_END),
+                  r'<mark>\1</mark>', text)
+    return Markup(text)
+
+
+def init_app(app):
+    app.add_template_filter(censor)
+    app.add_template_filter(highlight)
 
 
 # @app.context_processor
@@ -0,0 +1,166 @@
+from collections import OrderedDict
+from hashlib import sha1
+from threading import Lock, Thread
+from time import time
+from flask import current_app, render_template
+from markupsafe import Markup
+import os
+
+from app.util.files import write_atomically
+
+
+class MemoryBackend(object):
+    """
+    In-process LRU, private to each mod_wsgi process
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.get(key)
+            if value is not None:
+                self.items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+
+class FileBackend(object):
+    """
+    One file per fragment, shared by every thread and process on the host.
+    Writes go through a temporary file and an atomic rename. Every
+    prune_interval seconds a background thread deletes fragments not used
+    for max_age seconds and, past max_files, the least recently used.
+    """
+
+    def __init__(self, path, max_age, max_files, prune_interval):
+        self.path = path
+        self.max_age = max_age
+        self.max_files = max_files
+        self.prune_interval = prune_interval
+        self.last_prune = time()
+        self.lock = Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def filename(self, key):
+        digest = sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, digest[:2], digest)
+
+    def get(self, key):
+        filename = self.filename(key)
+        try:
+            with open(filename, encoding='utf-8') as f:
+                value = f.read()
+                used = os.fstat(f.fileno()).st_mtime
+        except FileNotFoundError:
+            return None
+        # The mtime records last use; refreshing it now and then is enough
+        if time() - used > self.max_age / 4:
+            try:
+                os.utime(filename)
+            except FileNotFoundError:
+                pass
+        return value
+
+    def set(self, key, value):
+        write_atomically(self.filename(key), value)
+
+        with self.lock:
+            due = time() - self.last_prune >= self.prune_interval
+            if due:
+                self.last_prune = time()
+        if due:
+            Thread(target=self.prune, name='fragment-pruner', daemon=True).start()
+
+    def prune(self):
+        """
+        Delete expired fragments, then the least recently used ones beyond
+        max_files. Returns how many were deleted.
+        """
+        cutoff = time() - self.max_age
+        kept, deleted = [], 0
+        for directory, _, names in os.walk(self.path):
+            for name in names:
+                filename = os.path.join(directory, name)
+                try:
+                    used = os.stat(filename).st_mtime
+                    if used < cutoff:
+                        os.remove(filename)
+                        deleted += 1
+                    else:
+                        kept.append((used, filename))
+                except FileNotFoundError:
+                    # Replaced or pruned by another process meanwhile
+                    pass
+        if len(kept) > self.max_files:
+            kept.sort()
+            for used, filename in kept[:len(kept) - self.max_files]:
+                try:
+                    os.remove(filename)
+                    deleted += 1
+                except FileNotFoundError:
+                    pass
+        return deleted
+
+
+def make_backend(config):
+    kind = config['FRAGMENT_CACHE']
+    if kind == 'memory':
+        return MemoryBackend(config['FRAGMENT_CACHE_SIZE'])
+    if kind == 'filesystem':
+        return FileBackend(config['FRAGMENT_CACHE_DIR'], config['FRAGMENT_CACHE_MAX_AGE'],
+                           config['FRAGMENT_CACHE_MAX_FILES'],
+                           config['FRAGMENT_CACHE_PRUNE_INTERVAL'])
+    return None
+
+
+def slot(name):
+    """
+    Placeholder in a cached fragment for content filled in per request
+    """
+    return Markup('<!--slot:{}-->'.format(name))
+
+
+def fragment(template, item, fill=None, **context):
+    """
+    Render a viewer-independent partial for item, reusing the cached HTML
+    until item.updated_at changes. Anything that depends on the current user
+    must stay outside the fragment, or go into a slot() filled from fill.
+    """
+    backend = current_app.extensions.get('fragments')
+    if backend is None:
+        backend = current_app.extensions['fragments'] = make_backend(current_app.config) or False
+    # Archived rows render with the templates of the model they came from
+    name = getattr(item, 'template_name', type(item).__name__.lower())
+    context[name] = item
+    if not backend:
+        return compose(render_template(template, **context), fill)
+
+    key = '{}:{}:{}:{}'.format(
+        template, item.id, item.updated_at.isoformat() if item.updated_at else '',
+        sorted((k, v) for k, v in context.items() if k != name))
+    html = backend.get(key)
+    if html is None:
+        html = render_template(template, **context)
+        backend.set(key, html)
+    return compose(html, fill)
+
+
+def compose(html, fill):
+    for name, content in (fill or {}).items():
+        html = html.replace(str(slot(name)), str(content))
+    return Markup(html)
+
+
+def init_app(app):
+    app.add_template_global(slot)
+    app.add_template_global(fragment)
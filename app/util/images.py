@@ -0,0 +1,169 @@
+from datetime import datetime
+from hashlib import sha256
+from io import BytesIO
+import json
+import os
+
+try:
+    from PIL import Image as PILImage, ImageOps
+except ImportError:  # Pillow is optional; without it only the original is kept
+    PILImage = None
+
+from flask import current_app
+
+from app import db, images
+from app.util.files import write_atomically
+from app.util.jobs import task, enqueue
+
+
+def content_path(digest, ext):
+    return os.path.join(digest[:2], '{}.{}'.format(digest, ext))
+
+
+class ImageTooLarge(ValueError):
+    """
+    An upload whose pixel count exceeds Pillow's MAX_IMAGE_PIXELS, such as a
+    decompression bomb
+    """
+
+
+def write(name, data):
+    """
+    Write data under name, replacing any file there in one step
+    """
+    write_atomically(images.path(name), data)
+
+
+def write_once(name, data):
+    """
+    Write data under a content-addressed name unless it's already there
+    """
+    if not os.path.exists(images.path(name)):
+        write(name, data)
+
+
+def check(upload):
+    """
+    Read only the header of an uploaded FileStorage, raising ImageTooLarge
+    for too many pixels and ValueError if Pillow can't read it. Nothing is
+    decoded, so this is cheap enough for the request thread.
+    """
+    if PILImage is None:
+        return
+    try:
+        width, height = PILImage.open(upload.stream).size
+    except PILImage.DecompressionBombError as e:
+        raise ImageTooLarge(str(e))
+    except (OSError, SyntaxError) as e:
+        raise ValueError('Unreadable image: {}'.format(e))
+    finally:
+        upload.stream.seek(0)
+    if PILImage.MAX_IMAGE_PIXELS and width * height > PILImage.MAX_IMAGE_PIXELS:
+        raise ImageTooLarge('{}x{} pixels'.format(width, height))
+
+
+def strip(data):
+    """
+    Re-encode image bytes in their own format without EXIF (including GPS),
+    XMP or comments, applying the EXIF orientation first. Raises ValueError
+    if Pillow can't read them.
+    """
+    try:
+        original = PILImage.open(BytesIO(data))
+        fmt = original.format
+        if getattr(original, 'is_animated', False):
+            # Keep every frame; orientation is rare on animations
+            frames, options = original, dict(save_all=True)
+        else:
+            frames, options = ImageOps.exif_transpose(original), {}
+    except (OSError, SyntaxError) as e:
+        raise ValueError('Unreadable image: {}'.format(e))
+    if fmt == 'JPEG':
+        options['quality'] = 95
+    if original.info.get('icc_profile'):
+        # Color, not metadata about the picture or where it was taken
+        options['icc_profile'] = original.info['icc_profile']
+    out = BytesIO()
+    frames.save(out, fmt, **options)
+    return out.getvalue()
+
+
+def store(upload):
+    """
+    Save an uploaded FileStorage, already vetted with check(), under the hash
+    of its contents and return an unsaved Image for it. Re-uploads of the
+    same file reuse the stored files and any renditions already made from
+    them. Only renditions are ever served (see Image.fit), so without Pillow
+    the upload is kept but not shown. Decoding, including stripping the
+    original's metadata, is left to process_image.
+    """
+    from app.models import Image
+    data = upload.read()
+    digest = sha256(data).hexdigest()
+    ext = os.path.splitext(upload.filename)[1].lstrip('.').lower() or 'bin'
+    name = content_path(digest, ext)
+    write_once(name, data)
+
+    image = Image(filename=upload.filename, url=images.url(name), digest=digest)
+    done = Image.query.filter(Image.digest == digest, Image.renditions != None).first()
+    if done is not None:
+        image.width, image.height, image.renditions = done.width, done.height, done.renditions
+    return image, name
+
+
+def render(name):
+    """
+    Make every configured rendition of a stored original: oriented, scaled to
+    fit, stripped of metadata and re-encoded. Returns (width, height, renditions).
+    """
+    fmt = current_app.config['IMAGE_FORMAT']
+    with open(images.path(name), 'rb') as f:
+        original = PILImage.open(f)
+        original = ImageOps.exif_transpose(original)
+        original.load()
+    if original.mode not in ('RGB', 'RGBA'):
+        original = original.convert('RGBA' if 'transparency' in original.info else 'RGB')
+    digest = os.path.basename(name).split('.')[0]
+
+    renditions = {}
+    for label, size in sorted(current_app.config['IMAGE_RENDITIONS'].items(), key=lambda r: r[1]):
+        copy = original.copy()
+        copy.thumbnail((size, size), PILImage.LANCZOS)
+        out = BytesIO()
+        # Saving without exif/icc arguments drops the original metadata
+        copy.save(out, fmt, quality=current_app.config['IMAGE_QUALITY'])
+        rendition = content_path('{}-{}'.format(digest, size), fmt.lower())
+        write_once(rendition, out.getvalue())
+        renditions[label] = dict(name=rendition, width=copy.width, height=copy.height)
+    return original.width, original.height, renditions
+
+
+@task
+def process_image(image_id, name):
+    from app.models import Image
+    image = Image.query.get(image_id)
+    if image is None or image.renditions:
+        return
+    # The original is kept without its EXIF (including GPS), XMP or comments
+    with open(images.path(name), 'rb') as f:
+        write(name, strip(f.read()))
+    width, height, renditions = render(name)
+    # Uploads of the same file made while this job was queued share its output
+    for image in Image.query.filter(Image.digest == image.digest, Image.renditions == None):
+        image.width, image.height = width, height
+        image.renditions = json.dumps(renditions)
+        if image.post is not None:
+            # Invalidate cached fragments that point at the original
+            image.post.updated_at = datetime.utcnow()
+    db.session.commit()
+
+
+def schedule(image, name):
+    """
+    Queue rendition processing for a flushed Image; it runs once the caller
+    commits
+    """
+    if PILImage is None or image.renditions:
+        return
+    enqueue('process_image', dict(image_id=image.id, name=name),
+            key='image:{}'.format(image.digest))
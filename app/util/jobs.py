@@ -0,0 +1,187 @@
+"""
+A small persistent job queue kept in the application database.
+
+Functions registered with @task can be queued with enqueue() as part of the
+caller's transaction; worker threads claim due jobs with a conditional UPDATE
+(so several processes can share the queue), run them inside an app context,
+and retry failures with exponential backoff until max_attempts.
+"""
+from datetime import datetime, timedelta
+from threading import Event, Lock, Thread
+import json
+import traceback
+
+from flask import current_app
+from sqlalchemy import and_, event, func, or_
+from sqlalchemy.orm import Session
+
+from app import db
+from app.util.transfer import insert_ignoring
+
+
+tasks = {}
+
+
+def task(f):
+    """
+    Register f so it can be queued by name
+    """
+    tasks[f.__name__] = f
+    return f
+
+
+def enqueue(name, payload=None, key=None, delay=0):
+    """
+    Add tasks[name](**payload) to the session; it's queued when the caller
+    commits, and rolled back with the rest of its work otherwise. If key is
+    given and a job with the same name and key is still waiting or running,
+    that job is returned instead.
+    """
+    from app.models import Job
+    if name not in tasks:
+        raise KeyError('Unknown task {}'.format(name))
+
+    values = dict(name=name, key=key, payload=json.dumps(payload or {}), state='queued',
+                  attempts=0, max_attempts=current_app.config['JOB_MAX_ATTEMPTS'],
+                  run_at=datetime.utcnow() + timedelta(seconds=delay))
+    if key is None:
+        job = Job(**values)
+        db.session.add(job)
+        db.session.flush()
+    else:
+        # The partial unique index on pending (name, key) makes this a no-op
+        # when the job is already queued, even by a concurrent transaction
+        db.session.execute(insert_ignoring(Job.__table__), values)
+        job = Job.query.filter(Job.name == name, Job.key == key,
+                               Job.state.in_(('queued', 'running'))).first()
+    db.session.info['jobs_queued'] = True
+    return job
+
+
+@event.listens_for(Session, 'after_commit')
+def after_commit(db_session):
+    # Workers only see a job once the transaction that queued it commits
+    if db_session.info.pop('jobs_queued', False):
+        if current_app.config['JOBS_IN_PROCESS']:
+            workers.start()
+        workers.wake.set()
+
+
+@event.listens_for(Session, 'after_rollback')
+def after_rollback(db_session):
+    db_session.info.pop('jobs_queued', None)
+
+
+def claim():
+    """
+    Atomically take the next due job, or return None. Jobs left running past
+    JOB_TIMEOUT (their worker died) are due again.
+    """
+    from app.models import Job
+    now = datetime.utcnow()
+    stale = now - timedelta(seconds=current_app.config['JOB_TIMEOUT'])
+    due = or_(and_(Job.state == 'queued', Job.run_at <= now),
+              and_(Job.state == 'running', Job.updated_at < stale))
+
+    for id, in db.session.query(Job.id).filter(due).order_by(Job.run_at).limit(10).all():
+        claimed = Job.query.filter(Job.id == id, due).update(
+            {Job.state: 'running', Job.attempts: Job.attempts + 1, Job.updated_at: now},
+            synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return Job.query.get(id)
+    return None
+
+
+def run(job):
+    try:
+        tasks[job.name](**json.loads(job.payload))
+    except Exception:
+        db.session.rollback()
+        job.error = traceback.format_exc()
+        if job.attempts >= job.max_attempts:
+            job.state = 'failed'
+            current_app.logger.error('Job {} {} failed:\n{}'.format(job.id, job.name, job.error))
+        else:
+            job.state = 'queued'
+            backoff = current_app.config['JOB_BACKOFF'] * 2 ** (job.attempts - 1)
+            job.run_at = datetime.utcnow() + timedelta(seconds=backoff)
+    else:
+        job.state = 'done'
+        job.error = None
+    db.session.commit()
+
+
+def depth():
+    """
+    Queue metrics: job counts by state and the age in seconds of the oldest
+    due job
+    """
+    from app.models import Job
+    counts = dict(db.session.query(Job.state, func.count()).group_by(Job.state).all())
+    oldest = db.session.query(func.min(Job.run_at)).filter(
+        Job.state == 'queued', Job.run_at <= datetime.utcnow()).scalar()
+    return dict(counts,
+                oldest_due_seconds=(datetime.utcnow() - oldest).total_seconds() if oldest else 0)
+
+
+def prune(age):
+    """
+    Delete finished jobs older than age seconds
+    """
+    from app.models import Job
+    cutoff = datetime.utcnow() - timedelta(seconds=age)
+    Job.query.filter(Job.state == 'done', Job.updated_at < cutoff).delete(
+        synchronize_session=False)
+    db.session.commit()
+
+
+class WorkerPool(object):
+    """
+    A fixed number of threads working the queue, started by `flask worker` or
+    lazily inside the web process when JOBS_IN_PROCESS is set
+    """
+
+    def __init__(self):
+        self.threads = []
+        self.lock = Lock()
+        self.wake = Event()
+        self.stopped = Event()
+
+    def start(self, size=None):
+        """
+        Start the threads, working for the current application
+        """
+        app = current_app._get_current_object()
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(size or app.config['JOB_WORKERS']):
+                thread = Thread(target=self.work, args=(app,), name='job-worker-{}'.format(i),
+                                daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def work(self, app):
+        while not self.stopped.is_set():
+            with app.app_context():
+                try:
+                    job = claim()
+                    if job is not None:
+                        run(job)
+                        continue
+                except Exception:
+                    app.logger.exception('Job worker error')
+                finally:
+                    db.session.remove()
+            self.wake.wait(app.config['JOB_POLL_INTERVAL'])
+            self.wake.clear()
+
+    def stop(self):
+        self.stopped.set()
+        self.wake.set()
+        for thread in self.threads:
+            thread.join()
+
+
+workers = WorkerPool()
@@ -0,0 +1,41 @@
+from threading import Lock
+import os
+
+from jinja2 import FileSystemBytecodeCache
+
+
+class LazyExtension(object):
+    """
+    Stands in for an extension that isn't needed to serve pages. The first
+    attribute lookup calls factory() to import and set up the real one, and
+    every lookup is forwarded to it.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._extension = None
+        self._lock = Lock()
+
+    def _load(self):
+        if self._extension is None:
+            with self._lock:
+                if self._extension is None:
+                    self._extension = self._factory()
+        return self._extension
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+
+class LazyBytecodeCache(FileSystemBytecodeCache):
+    """
+    Jinja's on-disk bytecode cache, creating its directory on the first
+    write instead of when the app is built
+    """
+
+    def dump_bytecode(self, bucket):
+        os.makedirs(self.directory, exist_ok=True)
+        super(LazyBytecodeCache, self).dump_bytecode(bucket)
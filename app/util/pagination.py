@@ -0,0 +1,95 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as DecodeError
+from datetime import datetime
+from flask import request, url_for, abort
+from sqlalchemy import DateTime, tuple_
+import json
+
+
+def encode_cursor(values):
+    values = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    return urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, keys):
+    """
+    Turn an opaque cursor back into key values typed to match the sort columns
+    """
+    try:
+        values = json.loads(urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if len(values) != len(keys):
+            raise ValueError(cursor)
+        return [datetime.fromisoformat(v) if isinstance(key.type, DateTime) else v
+                for key, v in zip(keys, values)]
+    except (DecodeError, ValueError, TypeError):
+        abort(400)
+
+
+def paginate(items, per_page, *keys, attrs=None):
+    """
+    Keyset pagination over items, sorted descending by keys (the last of
+    which must be unique, usually the primary key). Pages are addressed by
+    ?after=<cursor> and ?before=<cursor> instead of an offset, so no COUNT is
+    run and every page costs one indexed range scan. attrs names the item
+    attributes holding each key's value, if they aren't the keys' own names.
+    """
+    attrs = attrs or [key.key for key in keys]
+    items = page_query(items, per_page, *keys).all()
+    has_more = len(items) > per_page
+    items = items[:per_page]
+    if request.args.get('before'):
+        items.reverse()
+
+    def cursor(item):
+        return encode_cursor([getattr(item, attr) for attr in attrs])
+
+    next_url, prev_url = page_links(items, has_more, cursor)
+    return items, next_url, prev_url
+
+
+def page_query(items, per_page, *keys):
+    """
+    items narrowed to the page the request's cursor addresses, plus one row
+    to tell whether there's another, in key order (ascending for ?before=).
+    Views also run it over a few columns to validate a page before loading it.
+    """
+    after = request.args.get('after')
+    before = request.args.get('before')
+    row = tuple_(*keys)
+
+    if before:
+        items = items.filter(row > tuple_(*decode_cursor(before, keys)))
+        items = items.order_by(*[key.asc() for key in keys])
+    else:
+        if after:
+            items = items.filter(row < tuple_(*decode_cursor(after, keys)))
+        items = items.order_by(*[key.desc() for key in keys])
+    return items.limit(per_page + 1)
+
+
+def page_url(**kwargs):
+    """
+    URL of the current view with its cursor replaced by kwargs
+    """
+    args = request.args.to_dict()
+    args.pop('after', None)
+    args.pop('before', None)
+    args.update(request.view_args)
+    args.update(kwargs)
+    return url_for(request.endpoint, **args)
+
+
+def page_links(items, has_more, cursor, **args):
+    """
+    (next_url, prev_url) for a page of items fetched with the current
+    request's cursor; cursor(item) encodes an item's position and args are
+    added to both URLs
+    """
+    after = request.args.get('after')
+    before = request.args.get('before')
+    next_url = prev_url = None
+    if items and (before or has_more):
+        next_url = page_url(after=cursor(items[-1]), **args)
+    if items and (has_more if before else after):
+        prev_url = page_url(before=cursor(items[0]), **args)
+    return next_url, prev_url
@@ -0,0 +1,206 @@
+"""
+Per-request instrumentation: SQL statement count and time (from engine
+events), template render time (from Flask's template signals) and total wall
+time, aggregated into per-endpoint histograms.
+
+Each process periodically writes its aggregates to PERF_DIR so the admin
+endpoint and `flask perf-report` can merge every mod_wsgi process's numbers.
+"""
+from collections import Counter, defaultdict
+from threading import Lock
+from time import perf_counter, time
+import json
+import os
+import re
+
+from flask import g, has_request_context, request, template_rendered, before_render_template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app.util.files import write_atomically
+
+
+# Upper bounds in milliseconds of the wall-time histogram buckets
+BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float('inf'))
+
+
+def bucket(ms):
+    for bound in BUCKETS:
+        if ms <= bound:
+            return str(bound)
+
+
+def shape(statement):
+    """
+    Collapse literals and IN lists so the same query with different values
+    counts as a repeat
+    """
+    statement = re.sub(r'\(\s*\?(\s*,\s*\?)*\s*\)', '(?)', statement)
+    statement = re.sub(r"'[^']*'|\b\d+\b", '?', statement)
+    return ' '.join(statement.split())
+
+
+class Stats(object):
+    def __init__(self):
+        self.lock = Lock()
+        self.endpoints = defaultdict(lambda: dict(
+            requests=0, wall_ms=0.0, sql_count=0, sql_ms=0.0, render_ms=0.0,
+            histogram=Counter()))
+
+    def add(self, endpoint, wall_ms, sql_count, sql_ms, render_ms):
+        with self.lock:
+            stats = self.endpoints[endpoint]
+            stats['requests'] += 1
+            stats['wall_ms'] += wall_ms
+            stats['sql_count'] += sql_count
+            stats['sql_ms'] += sql_ms
+            stats['render_ms'] += render_ms
+            stats['histogram'][bucket(wall_ms)] += 1
+
+    def dump(self):
+        with self.lock:
+            return {endpoint: dict(stats, histogram=dict(stats['histogram']))
+                    for endpoint, stats in self.endpoints.items()}
+
+
+def merge(dumps):
+    merged = {}
+    for dump in dumps:
+        for endpoint, stats in dump.items():
+            total = merged.setdefault(endpoint, dict(
+                requests=0, wall_ms=0.0, sql_count=0, sql_ms=0.0, render_ms=0.0,
+                histogram=Counter()))
+            for key in ('requests', 'wall_ms', 'sql_count', 'sql_ms', 'render_ms'):
+                total[key] += stats[key]
+            total['histogram'].update(stats['histogram'])
+    return merged
+
+
+def report(merged):
+    """
+    Turn merged totals into per-endpoint averages and percentile estimates
+    """
+    rows = {}
+    for endpoint, stats in merged.items():
+        n = stats['requests'] or 1
+        percentiles = {}
+        for p in (50, 95, 99):
+            seen = 0
+            for bound in BUCKETS:
+                seen += stats['histogram'].get(str(bound), 0)
+                if seen >= n * p / 100:
+                    # Past the last finite bound there's no upper estimate
+                    percentiles['p{}_ms'.format(p)] = bound if bound != float('inf') else None
+                    break
+        rows[endpoint] = dict(
+            requests=stats['requests'],
+            avg_ms=round(stats['wall_ms'] / n, 2),
+            avg_sql_count=round(stats['sql_count'] / n, 2),
+            avg_sql_ms=round(stats['sql_ms'] / n, 2),
+            avg_render_ms=round(stats['render_ms'] / n, 2),
+            histogram={str(b): stats['histogram'].get(str(b), 0) for b in BUCKETS},
+            **percentiles)
+    return rows
+
+
+class Instrumentation(object):
+
+    def __init__(self, app=None, db=None):
+        self.stats = Stats()
+        self.last_write = time()
+        self.write_lock = Lock()
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        self.app = app
+        self.path = app.config['PERF_DIR']
+        if not app.config['PERF_ENABLED']:
+            return
+
+        # On the Engine class so read replica engines, created lazily, are
+        # counted too (once, however many apps are built)
+        if not event.contains(Engine, 'before_cursor_execute', self.before_execute):
+            event.listen(Engine, 'before_cursor_execute', self.before_execute)
+            event.listen(Engine, 'after_cursor_execute', self.after_execute)
+        before_render_template.connect(self.before_render, app)
+        template_rendered.connect(self.after_render, app)
+        app.before_request(self.start)
+        app.after_request(self.finish)
+
+    # Collection
+
+    def start(self):
+        g.perf = dict(start=perf_counter(), sql_count=0, sql_ms=0.0, shapes=Counter(),
+                      render_depth=0, render_start=0.0, render_ms=0.0)
+
+    def before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if has_request_context() and 'perf' in g:
+            context._perf_start = perf_counter()
+
+    def after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if has_request_context() and 'perf' in g and hasattr(context, '_perf_start'):
+            g.perf['sql_count'] += 1
+            g.perf['sql_ms'] += (perf_counter() - context._perf_start) * 1000
+            g.perf['shapes'][shape(statement)] += 1
+
+    def before_render(self, sender, template, context, **extra):
+        if has_request_context() and 'perf' in g:
+            # Fragments render inside the page; only time the outermost render
+            if g.perf['render_depth'] == 0:
+                g.perf['render_start'] = perf_counter()
+            g.perf['render_depth'] += 1
+
+    def after_render(self, sender, template, context, **extra):
+        if has_request_context() and 'perf' in g:
+            g.perf['render_depth'] -= 1
+            if g.perf['render_depth'] == 0:
+                g.perf['render_ms'] += (perf_counter() - g.perf['render_start']) * 1000
+
+    def finish(self, response):
+        perf = g.pop('perf', None)
+        if perf is None:
+            return response
+        wall_ms = (perf_counter() - perf['start']) * 1000
+        endpoint = request.endpoint or 'unknown'
+        self.stats.add(endpoint, wall_ms, perf['sql_count'], perf['sql_ms'], perf['render_ms'])
+
+        if wall_ms >= self.app.config['PERF_SLOW_REQUEST_MS']:
+            repeated = [(n, s) for s, n in perf['shapes'].most_common(3) if n > 1]
+            self.app.logger.warning(
+                'Slow request {} {}: {:.0f}ms, {} queries in {:.0f}ms, render {:.0f}ms{}'.format(
+                    request.method, request.full_path, wall_ms, perf['sql_count'],
+                    perf['sql_ms'], perf['render_ms'],
+                    ''.join('\n  N+1 suspect x{}: {}'.format(n, s[:300]) for n, s in repeated)))
+
+        # One thread writes at a time, and a failed write is logged rather
+        # than turning the response into an error
+        if time() - self.last_write >= self.app.config['PERF_WRITE_INTERVAL'] and \
+                self.write_lock.acquire(blocking=False):
+            try:
+                self.write()
+            except Exception:
+                self.app.logger.exception('Failed to write request timings')
+            finally:
+                self.write_lock.release()
+        return response
+
+    # Reporting
+
+    def write(self):
+        self.last_write = time()
+        filename = os.path.join(self.path, '{}.json'.format(os.getpid()))
+        write_atomically(filename, json.dumps(self.stats.dump()))
+
+    def collect(self):
+        """
+        Merge the stats written by every process with this process's own
+        """
+        dumps = []
+        if os.path.isdir(self.path):
+            for name in os.listdir(self.path):
+                if name.endswith('.json') and name != '{}.json'.format(os.getpid()):
+                    with open(os.path.join(self.path, name)) as f:
+                        dumps.append(json.load(f))
+        dumps.append(self.stats.dump())
+        return report(merge(dumps))
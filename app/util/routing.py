@@ -0,0 +1,115 @@
+"""
+Read-replica routing for the Flask-SQLAlchemy session.
+
+Reads made while serving GET/HEAD requests go to one of the engines in
+SQLALCHEMY_REPLICA_URIS. Everything else goes to the primary: writes, locking
+reads, anything in a transaction that has already written, work outside a
+request (CLI, jobs), views marked @read_primary, and the requests of a client
+who committed a write within the last SQLALCHEMY_REPLICA_STALENESS seconds, so
+people see their own changes.
+"""
+from functools import wraps
+from random import choice
+from threading import Lock
+from time import time
+
+from flask import g, has_request_context, request, session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, orm
+from sqlalchemy.sql.dml import UpdateBase
+
+
+class RoutingSession(SignallingSession):
+
+    def __init__(self, db, **options):
+        super(RoutingSession, self).__init__(db, **options)
+        self.db = db
+        self.wrote = False
+
+    def execute(self, clause, *args, **kwargs):
+        # Core INSERT/UPDATE/DELETE don't flush, but later reads in the same
+        # transaction must see them just the same
+        if isinstance(clause, UpdateBase):
+            self.wrote = True
+        return super(RoutingSession, self).execute(clause, *args, **kwargs)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.use_primary(mapper, clause):
+            return super(RoutingSession, self).get_bind(mapper, clause)
+        return choice(self.db.get_replicas())
+
+    def use_primary(self, mapper, clause):
+        if not self.db.replica_uris or self.wrote or self._flushing:
+            return True
+        if mapper is not None and mapper.persist_selectable.info.get('bind_key'):
+            return True
+        if isinstance(clause, UpdateBase) or getattr(clause, '_for_update_arg', None) is not None:
+            return True
+        if not has_request_context() or request.method not in ('GET', 'HEAD'):
+            return True
+        return g.get('read_primary') or session.get('_read_primary_until', 0) > time()
+
+
+def read_primary(f):
+    """
+    Send every query of a GET view that writes to the primary, so the reads
+    it makes before writing (has_liked, is_following) can't see a stale
+    replica and repeat a write that already happened
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        g.read_primary = True
+        return f(*args, **kwargs)
+    return decorated
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def after_flush(db_session, flush_context):
+    db_session.wrote = True
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def after_commit(db_session):
+    if db_session.wrote and has_request_context():
+        g.read_primary = True
+        session['_read_primary_until'] = time() + db_session.db.replica_staleness
+    db_session.wrote = False
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def after_rollback(db_session):
+    db_session.wrote = False
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def init_app(self, app):
+        super(RoutingSQLAlchemy, self).init_app(app)
+        self.replica_uris = app.config.get('SQLALCHEMY_REPLICA_URIS') or []
+        self.replica_staleness = app.config.get('SQLALCHEMY_REPLICA_STALENESS', 5)
+        self.replica_options = app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {}
+        self.replicas = None
+        self.replica_lock = Lock()
+        self.connect_listeners = []
+
+    def on_connect(self, app, listener):
+        """
+        Call listener on each new DBAPI connection of app's primary engine
+        and of the replica engines
+        """
+        with app.app_context():
+            event.listen(self.get_engine(app), 'connect', listener)
+        self.connect_listeners.append(listener)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def get_replicas(self):
+        with self.replica_lock:
+            if self.replicas is None:
+                self.replicas = [create_engine(uri, **self.replica_options)
+                                 for uri in self.replica_uris]
+                for engine in self.replicas:
+                    for listener in self.connect_listeners:
+                        event.listen(engine, 'connect', listener)
+            return self.replicas
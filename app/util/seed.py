@@ -0,0 +1,117 @@
+"""
+Synthetic data for benchmarking. Rows are generated with a seeded RNG and
+written with executemany inserts, with popularity following a Zipf-like
+distribution so a few chats, posts and users get most of the activity.
+"""
+from bisect import bisect
+from datetime import datetime, timedelta
+from hashlib import md5
+from itertools import accumulate
+import random
+
+from app import db, passwords
+
+
+class Skewed(object):
+    """
+    Picks ids with weight 1 / rank**skew
+    """
+
+    def __init__(self, rng, ids, skew):
+        self.rng = rng
+        self.ids = list(ids)
+        self.cumulative = list(accumulate(1 / (rank ** skew) for rank in range(1, len(self.ids) + 1)))
+
+    def pick(self):
+        return self.ids[bisect(self.cumulative, self.rng.random() * self.cumulative[-1])]
+
+
+def next_id(model):
+    return (db.session.query(db.func.max(model.id)).scalar() or 0) + 1
+
+
+def insert(table, rows, chunk_size=5000):
+    for i in range(0, len(rows), chunk_size):
+        db.session.execute(table.insert(), rows[i:i + chunk_size])
+
+
+def seed(users=1000, chats=50, follows=10, posts=20000, likes=100000, comments=50000,
+         skew=1.1, days=90, password='password', random_seed=0):
+    from app import search
+    from app.models import User, Chat, Post, Like, Comment, followers, recount, rebuild_ranks, \
+        rebuild_timelines
+
+    rng = random.Random(random_seed)
+    now = datetime.utcnow()
+
+    def when():
+        return now - timedelta(seconds=rng.random() * days * 86400)
+
+    password_hash = passwords.hash(password)
+    first = next_id(User)
+    user_rows = []
+    for id in range(first, first + users):
+        email = 'user{}@example.com'.format(id)
+        user_rows.append(dict(id=id, username='user{}'.format(id), email=email,
+                              avatar_digest=md5(email.encode('utf-8')).hexdigest(),
+                              password_hash=password_hash, created_at=when(), last_seen=now))
+    insert(User.__table__, user_rows)
+    user_ids = [row['id'] for row in user_rows]
+    pick_user = Skewed(rng, user_ids, skew)
+
+    first = next_id(Chat)
+    chat_rows = [dict(id=id, name='chat{}'.format(id), about='Synthetic chat {}'.format(id),
+                      creator_id=rng.choice(user_ids), created_at=when())
+                 for id in range(first, first + chats)]
+    insert(Chat.__table__, chat_rows)
+    pick_chat = Skewed(rng, [row['id'] for row in chat_rows], skew)
+
+    follow_pairs = set()
+    for user_id in user_ids:
+        for _ in range(min(follows, chats)):
+            follow_pairs.add((user_id, pick_chat.pick()))
+    insert(followers, [dict(user_id=u, chat_id=c) for u, c in follow_pairs])
+
+    first = next_id(Post)
+    post_rows = []
+    for id in range(first, first + posts):
+        created = when()
+        post_rows.append(dict(id=id, title='Post {}'.format(id),
+                              body=' '.join(rng.choice(WORDS) for _ in range(rng.randint(5, 60))),
+                              author_id=pick_user.pick(), chat_id=pick_chat.pick(),
+                              created_at=created, updated_at=created))
+    insert(Post.__table__, post_rows)
+    post_ids = [row['id'] for row in post_rows]
+    pick_post = Skewed(rng, post_ids, skew)
+
+    like_pairs = set()
+    for _ in range(likes):
+        like_pairs.add((rng.choice(user_ids), pick_post.pick()))
+    insert(Like.__table__, [dict(user_id=u, post_id=p, created_at=now) for u, p in like_pairs])
+
+    first = next_id(Comment)
+    comment_rows, by_post = [], {}
+    for id in range(first, first + comments):
+        post_id = pick_post.pick()
+        siblings = by_post.setdefault(post_id, [])
+        parent = rng.choice(siblings) if siblings and rng.random() < 0.6 else None
+        comment_rows.append(dict(id=id, body=' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 30))),
+                                 author_id=pick_user.pick(), post_id=post_id,
+                                 parent_comment_id=parent, created_at=when()))
+        siblings.append(id)
+    insert(Comment.__table__, comment_rows)
+
+    db.session.commit()
+    # Bulk inserts bypass the ORM hooks, so rebuild everything derived
+    recount()
+    rebuild_ranks()
+    rebuild_timelines()
+    search.rebuild()
+    return dict(users=users, chats=chats, follows=len(follow_pairs), posts=posts,
+                likes=len(like_pairs), comments=comments)
+
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor '
+         'incididunt ut labore et dolore magna aliqua enim ad minim veniam quis nostrud '
+         'exercitation ullamco laboris nisi aliquip ex ea commodo consequat duis aute irure '
+         'in reprehenderit voluptate velit esse cillum fugiat nulla pariatur').split()
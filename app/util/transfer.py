@@ -0,0 +1,304 @@
+"""
+Streaming export and import of an instance's data as NDJSON.
+
+Each line is one row, {"type": <table>, <column>: <value>, ...}, written in
+dependency order (users, chats, follows, posts, images, likes, comments, then
+the archived posts, likes and comments).
+Files ending in .gz or .zst are compressed. Derived tables (rankings,
+timelines, search indexes) aren't exported; import rebuilds them.
+
+Import gives every row a new id, old id + the table's max id before the
+import began, so references can be remapped without a lookup table. Users
+whose email and chats whose name already exist (ignoring case, as logins and
+chat lookups do) are merged into the existing row instead; an imported user
+whose username is taken by someone else is renamed. Rows are inserted in chunks, skipping ones already present, and
+after each chunk the position is saved to a checkpoint file so an
+interrupted import picks up where it stopped.
+"""
+from contextlib import nullcontext
+from datetime import datetime
+import gzip
+import io
+import json
+import os
+
+try:
+    import zstandard
+except ImportError:  # zstandard is optional; without it only .gz and plain files work
+    zstandard = None
+
+from sqlalchemy import DateTime, func, select
+from sqlalchemy.dialects import postgresql
+
+from app import db
+from app.util.files import write_atomically
+
+
+def tables():
+    from app.models import User, Chat, Post, Image, Like, Comment, followers, \
+        ArchivedPost, ArchivedComment, ArchivedLike
+    return [User.__table__, Chat.__table__, followers, Post.__table__, Image.__table__,
+            Like.__table__, Comment.__table__,
+            ArchivedPost.__table__, ArchivedLike.__table__, ArchivedComment.__table__]
+
+
+# Archive tables share ids with the hot tables their rows came from, and
+# they and archived attachments reference other tables without foreign key
+# constraints
+ID_SPACES = {'post_archive': 'post', 'comment_archive': 'comment'}
+REFERENCES = {
+    'image': {'archived_post_id': 'post'},
+    'post_archive': {'author_id': 'user', 'chat_id': 'chat'},
+    'comment_archive': {'author_id': 'user', 'post_id': 'post', 'parent_comment_id': 'comment'},
+    'like_archive': {'user_id': 'user', 'post_id': 'post'},
+}
+
+
+def referenced(table, column):
+    """
+    Name of the id space column points into, or None
+    """
+    if column.foreign_keys:
+        return next(iter(column.foreign_keys)).column.table.name
+    if column.name in REFERENCES.get(table.name, {}):
+        return REFERENCES[table.name][column.name]
+    if column.name == 'id':
+        return ID_SPACES.get(table.name, table.name)
+    return None
+
+
+def open_file(path, mode):
+    """
+    Open path as text for 'r' or 'w', compressing by its extension
+    """
+    if path == '-':
+        import sys
+        # Leave the process's own streams open when the with block ends
+        return nullcontext(sys.stdin if mode == 'r' else sys.stdout)
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise RuntimeError('Install zstandard to read or write .zst files')
+        if mode == 'r':
+            stream = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+        else:
+            stream = zstandard.ZstdCompressor(level=3).stream_writer(open(path, 'wb'))
+        return io.TextIOWrapper(stream, encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(value)
+
+
+# Export
+
+def export(path, chunk_size=5000):
+    """
+    Write every exported table to path, returning {table: rows}
+    """
+    counts = {}
+    with open_file(path, 'w') as out:
+        for table in tables():
+            names = [column.name for column in table.columns]
+            rows = db.session.query(*table.columns).order_by(*table.primary_key.columns)
+            # Server-side cursor where the driver supports it, so memory
+            # stays flat however big the table is
+            rows = rows.execution_options(stream_results=True).yield_per(chunk_size)
+            count = 0
+            for row in rows:
+                record = dict(zip(names, row), type=table.name)
+                out.write(json.dumps(record, default=default, separators=(',', ':')))
+                out.write('\n')
+                count += 1
+            counts[table.name] = count
+    return counts
+
+
+# Import
+
+class Importer(object):
+
+    # Columns identifying a row that may already exist in the target
+    MERGE_ON = {'user': ('email',), 'chat': ('name',)}
+    # Unique columns of rows that weren't merged, made unique by a suffix
+    # when the value is taken (compared case-insensitively, like logins)
+    RENAME_ON = {'user': 'username'}
+
+    def __init__(self, checkpoint):
+        self.checkpoint = checkpoint
+        self.tables = {table.name: table for table in tables()}
+        state = {}
+        if checkpoint and os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                state = json.load(f)
+        self.line = state.get('line', 0)
+        self.offsets = state.get('offsets') or self.max_ids()
+        self.merged = {name: {int(old): new for old, new in ids.items()}
+                       for name, ids in state.get('merged', {}).items()}
+        self.counts = state.get('counts', {})
+
+    def max_ids(self):
+        offsets = {}
+        for name, table in self.tables.items():
+            if 'id' in table.c:
+                space = ID_SPACES.get(name, name)
+                offsets[space] = max(offsets.get(space, 0),
+                                     db.session.query(func.max(table.c.id)).scalar() or 0)
+        return offsets
+
+    def new_id(self, name, old):
+        if old is None:
+            return None
+        return self.merged.get(name, {}).get(old, old + self.offsets[name])
+
+    def convert(self, table, record):
+        row = {}
+        for column in table.columns:
+            value = record.get(column.name)
+            if value is not None and isinstance(column.type, DateTime):
+                value = datetime.fromisoformat(value)
+            space = referenced(table, column)
+            if space:
+                value = self.new_id(space, value)
+            row[column.name] = value
+        return row
+
+    def merge(self, table, records):
+        """
+        Map records whose unique columns match existing rows, or records
+        earlier in the chunk, onto those rows, and return the rest. Values are
+        compared case-insensitively.
+        """
+        columns = self.MERGE_ON.get(table.name)
+        if not columns:
+            return records
+        existing = {}
+        for column in columns:
+            values = {record[column].lower() for record in records if record[column]}
+            for id, value in db.session.query(table.c.id, table.c[column]).filter(
+                    func.lower(table.c[column]).in_(values)):
+                existing[(column, value.lower())] = id
+        fresh = []
+        for record in records:
+            keys = [(column, record[column].lower()) for column in columns if record[column]]
+            matches = [existing[key] for key in keys if key in existing]
+            if matches:
+                self.merged.setdefault(table.name, {})[record['id']] = matches[0]
+            else:
+                fresh.append(record)
+                existing.update((key, self.new_id(table.name, record['id'])) for key in keys)
+        return fresh
+
+    def rename(self, table, records):
+        """
+        Give records whose RENAME_ON value is already taken, in the target or
+        earlier in records, the value with their new id appended (digits
+        only, so renamed usernames still pass the registration form's rules)
+        """
+        column = self.RENAME_ON.get(table.name)
+        if not column:
+            return
+        values = {record[column].lower() for record in records if record[column]}
+        taken = {value.lower() for value, in db.session.query(table.c[column]).filter(
+            func.lower(table.c[column]).in_(values))}
+        width = table.c[column].type.length
+        for record in records:
+            value = record[column]
+            if not value:
+                continue
+            attempt = 1
+            while value.lower() in taken:
+                suffix = str(self.new_id(table.name, record['id']))
+                if attempt > 1:
+                    suffix += str(attempt)
+                value = record[column][:width - len(suffix)] + suffix
+                if db.session.query(table.c.id).filter(
+                        func.lower(table.c[column]) == value.lower()).first():
+                    taken.add(value.lower())
+                attempt += 1
+            record[column] = value
+            taken.add(value.lower())
+
+    def insert(self, name, records):
+        table = self.tables[name]
+        records = self.merge(table, records)
+        self.rename(table, records)
+        if records:
+            rows = [self.convert(table, record) for record in records]
+            db.session.execute(insert_ignoring(table), rows)
+        self.counts[name] = self.counts.get(name, 0) + len(records)
+
+    def save(self, line):
+        db.session.commit()
+        self.line = line
+        if self.checkpoint:
+            state = dict(line=line, offsets=self.offsets, merged=self.merged, counts=self.counts)
+            write_atomically(self.checkpoint, json.dumps(state))
+
+    def run(self, path, chunk_size=5000):
+        name, chunk, number = None, [], 0
+        with open_file(path, 'r') as lines:
+            for number, line in enumerate(lines, 1):
+                if number <= self.line:
+                    continue
+                record = json.loads(line)
+                kind = record.pop('type')
+                if kind not in self.tables:
+                    raise ValueError('Unknown row type {!r} on line {}'.format(kind, number))
+                if chunk and (kind != name or len(chunk) >= chunk_size):
+                    self.insert(name, chunk)
+                    self.save(number - 1)
+                    chunk = []
+                name = kind
+                chunk.append(record)
+        if chunk:
+            self.insert(name, chunk)
+        self.save(number)
+        reset_sequences(self.tables.values())
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+        return self.counts
+
+
+def insert_ignoring(table):
+    """
+    INSERT that skips rows whose key already exists, so a chunk replayed
+    after a crash between commit and checkpoint is harmless
+    """
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    if dialect == 'sqlite':
+        return table.insert().prefix_with('OR IGNORE')
+    return table.insert()
+
+
+def reset_sequences(tables):
+    # Rows were inserted with explicit ids, which Postgres sequences don't see
+    if db.session.get_bind().dialect.name != 'postgresql':
+        return
+    for table in tables:
+        if 'id' in table.c:
+            db.session.execute(select([func.setval(
+                func.pg_get_serial_sequence(table.name, 'id'),
+                func.coalesce(func.max(table.c.id), 0) + 1, False)]))
+    db.session.commit()
+
+
+def import_(path, chunk_size=5000, checkpoint=None):
+    """
+    Load an export into the database and rebuild derived data, returning
+    {table: rows loaded} (merged users and chats aren't counted)
+    """
+    from app import search
+    from app.models import recount, rebuild_ranks, rebuild_timelines
+    counts = Importer(checkpoint).run(path, chunk_size)
+    recount()
+    rebuild_ranks()
+    rebuild_timelines()
+    search.rebuild()
+    return counts
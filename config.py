@@ -8,8 +8,47 @@ class Config(object):
         'sqlite:///' + os.path.join(basedir, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # Read replicas for GET requests (app/util/routing.py), as a
+    # space-separated DATABASE_REPLICA_URLS. After a client commits a write,
+    # its reads stay on the primary for SQLALCHEMY_REPLICA_STALENESS seconds.
+    SQLALCHEMY_REPLICA_URIS = (os.environ.get('DATABASE_REPLICA_URLS') or '').split()
+    SQLALCHEMY_REPLICA_STALENESS = 5
+
+    # Applied to every new SQLite connection. WAL lets readers proceed while
+    # a write is in progress, which matters with 5 mod_wsgi threads.
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -16000,
+        'temp_store': 'MEMORY',
+    }
+    if SQLALCHEMY_DATABASE_URI.startswith('sqlite'):
+        SQLALCHEMY_ENGINE_OPTIONS = {}
+    else:
+        # One connection per mod_wsgi thread, plus headroom for background
+        # workers
+        SQLALCHEMY_ENGINE_OPTIONS = {
+            'pool_size': int(os.environ.get('DATABASE_POOL_SIZE') or 5),
+            'max_overflow': int(os.environ.get('DATABASE_MAX_OVERFLOW') or 5),
+            'pool_timeout': 10,
+            'pool_recycle': 1800,
+            'pool_pre_ping': True,
+        }
+
     SENTRY_DSN = None
 
+    # Request instrumentation (app/util/perf.py)
+    PERF_ENABLED = True
+    PERF_SLOW_REQUEST_MS = 500
+    PERF_WRITE_INTERVAL = 30
+    PERF_DIR = os.path.join(basedir, 'cache', 'perf')
+
+    # How often buffered last_seen times are written, in seconds
+    LAST_SEEN_INTERVAL = 60
+    LAST_SEEN_BATCH_SIZE = 500
+
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
@@ -22,9 +61,92 @@ class Config(object):
     CHATS_PER_PAGE = 25
     USERS_PER_PAGE = 25
 
+    # JSON API (/api/v1): largest ?limit= accepted, and smallest response
+    # worth compressing, in bytes
+    API_MAX_PER_PAGE = 100
+    API_COMPRESS_MIN_SIZE = 1024
+
+    # Home feed timelines: rows kept per user, and the follower count above
+    # which a chat's posts are merged in at read time instead of fanned out
+    TIMELINE_LENGTH = 800
+    TIMELINE_FANOUT_LIMIT = 10000
+    TIMELINE_TRIM_DELAY = 60
+
+    # Levels of replies shown under each comment before "more replies"
+    COMMENT_MAX_DEPTH = 4
+
+    # Seconds of post age that one order of magnitude of likes makes up for
+    # in the "hot" ranking
+    RANK_HOT_DECAY = 45000
+
+    CENSOR_WORDS = ['dick', 'fuck', 'cock']
+    CENSOR_WORDS_FILE = os.environ.get('CENSOR_WORDS_FILE')
+    CENSOR_CACHE_SIZE = 4096
+
+    # Rendered post and comment fragments: 'memory' (per-process LRU),
+    # 'filesystem' (shared between mod_wsgi processes) or None to disable
+    FRAGMENT_CACHE = os.environ.get('FRAGMENT_CACHE') or 'memory'
+    FRAGMENT_CACHE_SIZE = 10000
+    FRAGMENT_CACHE_DIR = os.environ.get('FRAGMENT_CACHE_DIR') or \
+        os.path.join(basedir, 'cache', 'fragments')
+    # Filesystem fragments unused for FRAGMENT_CACHE_MAX_AGE seconds, and the
+    # least recently used beyond FRAGMENT_CACHE_MAX_FILES, are deleted every
+    # FRAGMENT_CACHE_PRUNE_INTERVAL seconds
+    FRAGMENT_CACHE_MAX_AGE = 7 * 24 * 3600
+    FRAGMENT_CACHE_MAX_FILES = 100000
+    FRAGMENT_CACHE_PRUNE_INTERVAL = 600
+
     UPLOADS_DEFAULT_DEST = os.path.join(basedir, 'app/static/img/')
     # UPLOADS_DEFAULT_URL = 'http://puffyboa.xyz/openchat/static/img/'
 
     UPLOADED_IMAGES_DEST = os.path.join(basedir, 'app/static/img/')
+
+    # Live updates (app/util/events.py), off unless LIVE_UPDATES is set:
+    # seconds between a page's polls, how far back each poll re-reads to
+    # catch events committed out of order (keep it above the replica lag),
+    # and how long events are kept
+    LIVE_UPDATES = os.environ.get('LIVE_UPDATES') is not None
+    EVENTS_POLL_INTERVAL = 5
+    EVENTS_WINDOW = 30
+    EVENTS_RETENTION = 3600
+    EVENTS_MAX_CHANNELS = 50
+    EVENTS_MAX_BATCH = 100
+
+    # Password hashing; existing hashes are upgraded when their owner next
+    # logs in after these change
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'pbkdf2:sha256:150000'
+    PASSWORD_SALT_LENGTH = 16
+
+    # Login attempts allowed per client address and per username, refilling
+    # over LOGIN_ATTEMPT_PERIOD seconds
+    LOGIN_ATTEMPTS = 10
+    LOGIN_ATTEMPT_PERIOD = 300
+
+    # Archival of old posts (`flask archive`)
+    ARCHIVE_AFTER_DAYS = 365
+    ARCHIVE_BATCH_SIZE = 500
+
+    # Compiled Jinja templates
+    TEMPLATE_CACHE_DIR = os.path.join(basedir, 'cache', 'templates')
+
+    # Generated identicons, served from /avatar/<digest>/<size>
+    AVATAR_DIR = os.path.join(basedir, 'cache', 'avatars')
+    AVATAR_SIZES = (25, 50, 70, 128, 256)
+    AVATAR_CACHE_SIZE = 2048
+    AVATAR_MAX_AGE = 365 * 24 * 3600
+
+    # Background jobs (app/util/jobs.py). With JOBS_IN_PROCESS the web
+    # process runs its own workers; otherwise run `flask worker`.
+    JOBS_IN_PROCESS = True
+    JOB_WORKERS = 2
+    JOB_POLL_INTERVAL = 5
+    JOB_MAX_ATTEMPTS = 5
+    JOB_BACKOFF = 30
+    JOB_TIMEOUT = 600
+
+    # Longest side in pixels of each resized copy made from an upload
+    IMAGE_RENDITIONS = {'thumb': 256, 'feed': 800, 'full': 1600}
+    IMAGE_FORMAT = 'WEBP'
+    IMAGE_QUALITY = 80
     # UPLOADED_IMAGES_URL = 'http://puffyboa.xyz/openchat/static/img/'
 
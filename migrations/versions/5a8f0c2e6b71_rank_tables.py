@@ -0,0 +1,85 @@
+"""Rank tables
+
+Revision ID: 5a8f0c2e6b71
+Revises: 3c1e7a9b2d40
+Create Date: 2026-10-18 18:21:40.903127
+
+"""
+from datetime import datetime
+import math
+
+from alembic import op
+from flask import current_app
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5a8f0c2e6b71'
+down_revision = '3c1e7a9b2d40'
+branch_labels = None
+depends_on = None
+
+
+HOT_EPOCH = datetime(2020, 1, 1)
+
+user = sa.table('user', sa.column('id'), sa.column('score'), sa.column('created_at', sa.DateTime))
+chat = sa.table('chat', sa.column('id'), sa.column('follower_count'),
+                sa.column('created_at', sa.DateTime))
+post = sa.table('post', sa.column('id'), sa.column('author_id'), sa.column('chat_id'),
+                sa.column('like_count'), sa.column('created_at', sa.DateTime))
+like = sa.table('like', sa.column('post_id'), sa.column('created_at', sa.DateTime))
+
+
+def hotness(total, active_at):
+    # app.models.hotness as of this revision
+    order = math.log10(max(abs(total), 1))
+    sign = 1 if total > 0 else -1 if total < 0 else 0
+    seconds = (active_at - HOT_EPOCH).total_seconds()
+    return round(sign * order + seconds / current_app.config['RANK_HOT_DECAY'], 7)
+
+
+def create_rank_table(name, item):
+    table = op.create_table(name,
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.Column('total', sa.Integer(), nullable=False),
+    sa.Column('hot', sa.Float(), nullable=False),
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['id'], ['{}.id'.format(item)], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_{}_hot'.format(name), name, ['hot', 'id'], unique=False)
+    op.create_index('ix_{}_total'.format(name), name, ['total', 'id'], unique=False)
+    return table
+
+
+def fill(table, rows):
+    # As `flask rank` does: only items with a nonzero total are ranked
+    now = datetime.utcnow()
+    op.bulk_insert(table, [
+        dict(id=id, total=total, hot=hotness(total, active_at or now),
+             created_at=now, updated_at=now)
+        for id, total, active_at in op.get_bind().execute(rows) if total])
+
+
+def upgrade():
+    post_rank = create_rank_table('post_rank', 'post')
+    chat_rank = create_rank_table('chat_rank', 'chat')
+    user_rank = create_rank_table('user_rank', 'user')
+
+    fill(post_rank, sa.select([post.c.id, post.c.like_count, post.c.created_at]))
+    newest_post = sa.select([sa.func.max(post.c.created_at)]).where(
+        post.c.chat_id == chat.c.id).as_scalar()
+    fill(chat_rank, sa.select([chat.c.id, chat.c.follower_count,
+                               sa.func.coalesce(newest_post, chat.c.created_at)]))
+    newest_like = sa.select([sa.func.max(like.c.created_at)]).where(
+        (like.c.post_id == post.c.id) & (post.c.author_id == user.c.id)).as_scalar()
+    fill(user_rank, sa.select([user.c.id, user.c.score,
+                               sa.func.coalesce(newest_like, user.c.created_at)]))
+
+
+def downgrade():
+    for name in ('user_rank', 'chat_rank', 'post_rank'):
+        op.drop_index('ix_{}_total'.format(name), table_name=name)
+        op.drop_index('ix_{}_hot'.format(name), table_name=name)
+        op.drop_table(name)
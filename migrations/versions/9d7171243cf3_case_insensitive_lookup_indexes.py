@@ -0,0 +1,37 @@
+"""Case-insensitive lookup indexes
+
+Revision ID: 9d7171243cf3
+Revises: e4b0d9a7c126
+Create Date: 2026-10-18 17:50:07.357349
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d7171243cf3'
+down_revision = 'e4b0d9a7c126'
+branch_labels = None
+depends_on = None
+
+
+# Login, registration and chat lookups compare lower(column). Autogenerate
+# can't reflect expression indexes (app/__init__.py keeps it from comparing
+# them), so they live here. IF NOT EXISTS because `flask indexes` created
+# them on some databases before this migration existed.
+INDEXES = [
+    ('ix_user_username_lower', 'user', 'username'),
+    ('ix_user_email_lower', 'user', 'email'),
+    ('ix_chat_name_lower', 'chat', 'name'),
+]
+
+
+def upgrade():
+    for name, table, column in INDEXES:
+        op.execute('CREATE INDEX IF NOT EXISTS {} ON "{}" (lower({}))'.format(name, table, column))
+
+
+def downgrade():
+    for name, table, column in INDEXES:
+        op.drop_index(name, table_name=table)
@@ -0,0 +1,259 @@
+from datetime import datetime, timedelta
+from unittest import mock
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from sqlalchemy import event
+
+from app import create_app, db, activity, include_object
+from app.models import User, Post, Chat, Comment, Image, Job, Timeline, ArchivedPost, \
+    archive_posts
+from app.util.transfer import Importer, export, import_
+from config import Config, basedir
+
+db_fd, db_path = tempfile.mkstemp(suffix='.db')
+
+
+class TestConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = 'sqlite:///' + db_path
+    SQLALCHEMY_ENGINE_OPTIONS = {}
+    WTF_CSRF_ENABLED = False
+    JOBS_IN_PROCESS = False
+    FRAGMENT_CACHE = None
+    PERF_ENABLED = False
+
+
+app = create_app(TestConfig)
+
+
+def tearDownModule():
+    os.close(db_fd)
+    os.remove(db_path)
+
+
+class AppCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.drop_all()
+        db.create_all()
+
+    def tearDown(self):
+        activity.flush()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+
+class MigrationCase(AppCase):
+
+    def test_migrations_match_models(self):
+        from alembic.autogenerate import compare_metadata
+        from alembic.migration import MigrationContext
+        from flask_migrate import upgrade
+        db.drop_all()
+        upgrade(directory=os.path.join(basedir, 'migrations'))
+        try:
+            with db.engine.connect() as connection:
+                context = MigrationContext.configure(
+                    connection, opts=dict(include_object=include_object))
+                self.assertEqual(compare_metadata(context, db.metadata), [])
+        finally:
+            db.engine.execute('DROP TABLE alembic_version')
+
+
+class FanOutCase(AppCase):
+
+    def test_fan_out_is_part_of_the_post_transaction(self):
+        user = User(username='user', email='user@example.com')
+        chat = Chat(name='chat', about='about', creator=user)
+        db.session.add_all([user, chat])
+        db.session.commit()
+        user.follow(chat)
+        db.session.commit()
+
+        post = Post(title='post', body='body', chat=chat, author=user)
+        db.session.add(post)
+        db.session.flush()
+        Timeline.fan_out(post)
+        db.session.rollback()
+
+        self.assertEqual(Post.query.count(), 0)
+        self.assertEqual(Timeline.query.count(), 0)
+        self.assertEqual(Job.query.count(), 0)
+
+
+class TransferCase(AppCase):
+
+    def setUp(self):
+        super(TransferCase, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'export.ndjson')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        super(TransferCase, self).tearDown()
+
+    def round_trip(self):
+        export(self.path)
+        return import_(self.path, checkpoint=self.path + '.checkpoint')
+
+    def write(self, records):
+        with open(self.path, 'w') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+
+    def test_users_merge_on_email_and_renames_stay_alphanumeric(self):
+        db.session.add_all([User(username='bob', email='bob@example.com'),
+                            User(username='alice', email='alice@example.com')])
+        db.session.commit()
+        self.write([
+            dict(type='user', id=1, username='robert', email='Bob@Example.com', score=0),
+            dict(type='user', id=2, username='Alice', email='other@example.com', score=0),
+            dict(type='user', id=3, username='carol', email='OTHER@example.com', score=0),
+        ])
+
+        import_(self.path, checkpoint=self.path + '.checkpoint')
+
+        self.assertEqual(User.query.count(), 3)
+        renamed = User.query.filter_by(email='other@example.com').one()
+        self.assertNotEqual(renamed.username.lower(), 'alice')
+        self.assertTrue(renamed.username.isalnum())
+
+    def test_interrupted_import_resumes_from_checkpoint(self):
+        user = User(username='user', email='user@example.com')
+        chat = Chat(name='chat', about='about', creator=user)
+        db.session.add_all([user, chat])
+        db.session.add_all([Post(title='post {}'.format(i), body='body', chat=chat, author=user)
+                            for i in range(10)])
+        db.session.commit()
+        export(self.path)
+
+        calls = []
+        insert = Importer.insert
+
+        def fail_on_third_chunk(importer, name, records):
+            calls.append(name)
+            if len(calls) == 3:
+                raise RuntimeError('interrupted')
+            insert(importer, name, records)
+
+        checkpoint = self.path + '.checkpoint'
+        with mock.patch.object(Importer, 'insert', fail_on_third_chunk):
+            with self.assertRaises(RuntimeError):
+                Importer(checkpoint).run(self.path, chunk_size=3)
+        db.session.rollback()
+        self.assertTrue(os.path.exists(checkpoint))
+
+        import_(self.path, chunk_size=3, checkpoint=checkpoint)
+
+        self.assertFalse(os.path.exists(checkpoint))
+        self.assertEqual(Post.query.count(), 20)
+        self.assertEqual(User.query.count(), 1)
+
+    def test_archived_attachments_follow_their_posts(self):
+        user = User(username='user', email='user@example.com')
+        chat = Chat(name='chat', about='about', creator=user)
+        post = Post(title='post', body='body', chat=chat, author=user,
+                    created_at=datetime.utcnow() - timedelta(days=400))
+        post.attachment = Image(filename='a.png', url='/a.png')
+        db.session.add_all([user, chat, post])
+        db.session.commit()
+        archive_posts()
+        old_id = ArchivedPost.query.one().id
+
+        self.round_trip()
+
+        imported = ArchivedPost.query.filter(ArchivedPost.id != old_id).one()
+        self.assertIsNotNone(imported.attachment)
+        self.assertEqual(imported.attachment.archived_post_id, imported.id)
+        self.assertEqual(ArchivedPost.query.get(old_id).attachment.archived_post_id, old_id)
+
+
+class QueryCountCase(AppCase):
+    """
+    Feed and post pages load their rows with a fixed number of queries, however
+    many posts, authors and comments are on the page
+    """
+
+    # Upper bound on queries per page, including the session's user lookup
+    MAX_QUERIES = 8
+
+    def setUp(self):
+        super(QueryCountCase, self).setUp()
+        self.statements = []
+        event.listen(db.engine, 'before_cursor_execute', self.count)
+
+    def tearDown(self):
+        event.remove(db.engine, 'before_cursor_execute', self.count)
+        super(QueryCountCase, self).tearDown()
+
+    def count(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def add_posts(self, chat, authors, n):
+        posts = []
+        for i in range(n):
+            post = Post(title='post {}'.format(i), body='body', chat=chat,
+                        author=authors[i % len(authors)])
+            post.attachment = Image(filename='a.png', url='/a.png')
+            db.session.add(post)
+            posts.append(post)
+        db.session.commit()
+        for post in posts:
+            for author in authors[:3]:
+                db.session.add(Comment(body='comment', post=post, author=author))
+        db.session.commit()
+        return posts
+
+    def queries(self, url):
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = '1'
+            session['_fresh'] = True
+        db.session.remove()
+        del self.statements[:]
+        response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(self.statements)
+
+    def test_pages_use_constant_queries(self):
+        authors = [User(username='user{}'.format(i), email='user{}@example.com'.format(i))
+                   for i in range(10)]
+        chat = Chat(name='chat', about='about', creator=authors[0])
+        db.session.add_all(authors + [chat])
+        db.session.commit()
+        for user in authors:
+            user.follow(chat)
+        db.session.commit()
+
+        posts = self.add_posts(chat, authors, 3)
+        post_id = posts[0].id
+        first_id = Comment.query.filter_by(post_id=post_id).first().id
+        for author in authors:
+            db.session.add(Comment(body='reply', post_id=post_id, author=author,
+                                   parent_comment_id=first_id))
+        db.session.commit()
+        urls = ['/index', '/chat/chat', '/post/{}'.format(post_id)]
+        few = {url: self.queries(url) for url in urls}
+
+        authors = User.query.all()
+        self.add_posts(Chat.query.first(), authors, 20)
+        for author in authors:
+            db.session.add(Comment(body='another reply', post_id=post_id, author=author,
+                                   parent_comment_id=first_id))
+        db.session.commit()
+        many = {url: self.queries(url) for url in urls}
+
+        for url in urls:
+            self.assertLessEqual(many[url], self.MAX_QUERIES, url)
+            self.assertEqual(few[url], many[url], url)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)